@@ -3,24 +3,241 @@
 Different music content analysers are stored here.
 The system was built on top of Essentia, however in order to
 use some other analyser you just need to provide
+an object with the same ``analyse_audio`` and ``analyse_batch`` methods,
+like the ``NumpyAnalyser``.
 """
 
-import subprocess, os, re
+import subprocess, os, re, shutil, filecmp, tempfile, errno, hashlib, time
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
-from scikits.audiolab import wavread
+from scikits.audiolab import Sndfile, wavread
+import yaml
 
 
 
-from hmosaic.utils import switch_ext, load_yaml 
+from hmosaic.utils import switch_ext, load_yaml, file_hash, to_mono
+from hmosaic.utils import get_frame_matrix
+from hmosaic.utils import read_unit, is_virtual_unit, export_unit
+from hmosaic.utils import locate_virtual_unit
+from hmosaic.cache import ContentCache
+from hmosaic.store import read_analysis
 from hmosaic import log, settings
 
 
+# Names of the unit analysers, as used in settings.UNIT_ANALYSER
+ESSENTIA_ANALYSER = 'essentia'
+NUMPY_ANALYSER = 'numpy'
+
+
 class EssentiaError(Exception):
     """
     """
     pass
 
-class EssentiaAnalyser:
+class AnalyserMismatchError(Exception):
+    """
+        Raised when units analysed by different analysers are compared,
+        as their descriptors are not on the same scale.
+    """
+    pass
+
+class AnalysisResult(object):
+    """
+        Outcome of analysing a single file in batch mode.
+         *  ``filepath`` - the audio file which was presented for analysis.
+         *  ``error`` - the exception raised for this file, usually an
+            ``EssentiaError``, or **None** if the analysis succeeded.
+         *  ``elapsed`` - the time taken to analyse the file in seconds.
+
+    """
+    def __init__(self, filepath, error=None, elapsed=None):
+        self.filepath = filepath
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        if self.error:
+            return "<AnalysisResult %s: %s>" % (self.filepath, self.error)
+        return "<AnalysisResult %s>" % self.filepath
+
+class Invocation(object):
+    """
+        Measurements of a single run of an analyser binary, which are passed
+        to the hooks of the ``EssentiaAnalyser``.
+         *  ``filepath`` - the audio file which was analysed.
+         *  ``attempt`` - 1 for the first run on this file, 2 for the first
+            retry, etc.
+         *  ``wall_time`` and ``cpu_time`` - seconds taken by the run, the 
+            cpu time is user plus system time of the binary.
+         *  ``output_size`` - bytes of analysis written, 0 if none.
+         *  ``returncode`` - the exit status, negative if killed by a signal.
+         *  ``timed_out`` - True if the run was killed for taking too long.
+
+    """
+    def __init__(self, filepath, attempt):
+        self.filepath = filepath
+        self.attempt = attempt
+        self.wall_time = None
+        self.cpu_time = None
+        self.output_size = 0
+        self.returncode = None
+        self.timed_out = False
+
+    def __repr__(self):
+        return "<Invocation %s #%d: %.3fs wall, %.3fs cpu, %d bytes>" % (
+            self.filepath, self.attempt, self.wall_time, self.cpu_time, 
+            self.output_size)
+
+# Hashes of analyser binaries, keyed on (path, size, mtime) so that each 
+# binary is only read once per process.
+_bin_ids = {}
+
+def bin_identity(bin_path):
+    """
+        Returns a string identifying the analyser binary at ``bin_path``.
+        This is a hash of the binary itself, so that replacing the binary
+        invalidates any cached analysis produced by the old one.
+
+    """
+    if not os.path.isfile(bin_path):
+        return hashlib.sha1(bin_path).hexdigest()
+    stat = os.stat(bin_path)
+    stamp = (bin_path, stat.st_size, stat.st_mtime)
+    if stamp not in _bin_ids:
+        _bin_ids[stamp] = file_hash(bin_path)
+    return _bin_ids[stamp]
+
+
+class AnalysisCache(ContentCache):
+    """
+        A content addressed store of analysis files. Each entry is keyed
+        on the hash of the audio which was analysed, combined with the 
+        identity of the analyser binary which produced it. A virtual unit
+        is keyed on the hash of its source file and its position in it, so
+        that its audio need not be exported to be looked up.
+
+    """
+
+    def __init__(self, location):
+        ContentCache.__init__(self, location, '.yaml')
+
+    def key(self, audio_filepath, bin_id):
+        """
+            Returns the cache key for ``audio_filepath`` analysed by the
+            binary identified by ``bin_id``.
+
+        """
+        if is_virtual_unit(audio_filepath):
+            (source, start, length) = locate_virtual_unit(audio_filepath)
+            return hashlib.sha1('%s%s:%d:%d' % (bin_id, 
+                self.hash_file(source), start, length)).hexdigest()
+        return hashlib.sha1(bin_id + self.hash_file(audio_filepath)
+            ).hexdigest()
+
+    def fetch(self, key, analysis_filepath):
+        """
+            If there is an entry for ``key`` make sure that 
+            ``analysis_filepath`` holds it, copying only if its contents 
+            differ. Returns **True** on a cache hit, **False** otherwise.
+
+        """
+        cached = self.lookup(key)
+        if cached is None:
+            return False
+        if not os.path.isfile(analysis_filepath) or \
+            not filecmp.cmp(cached, analysis_filepath, shallow=False):
+            shutil.copyfile(cached, analysis_filepath)
+        return True
+
+    def store(self, key, analysis_filepath):
+        """
+            Adds the analysis at ``analysis_filepath`` to the cache under
+            ``key``.
+
+        """
+        if not os.path.isfile(analysis_filepath):
+            return
+        def copy(f):
+            source = open(analysis_filepath, 'rb')
+            try:
+                shutil.copyfileobj(source, f)
+            finally:
+                source.close()
+        self.write(key, copy)
+
+
+class Analyser(object):
+    """
+        Base class for analysers, providing single and batch analysis of 
+        lists of files. Subclasses must have an ``analyse_audio`` method, 
+        which analyses one file, writes the analysis to a .yaml file with
+        the same filepath as the audio and raises an ``EssentiaError`` if 
+        the analysis fails.
+
+    """
+
+    def analyse(self, audio_files):
+        """
+             Parameter is a list of audio files.
+             A generator is returned with the analysis data for each file.
+
+        """
+        for filepath in audio_files:
+            yield self.analyse_audio(filepath)
+
+    def analyse_batch(self, audio_files, workers=None):
+        """
+            Batch mode. Analyses ``audio_files`` using a pool of ``workers``
+            threads, each analysing one file at a time. The essentia binary
+            runs in its own process so the threads only wait on it, and the
+            calling process is never forked (which matters inside the OSC 
+            daemon). If ``workers`` is **None** then the value from settings
+            is used, falling back to the number of cpus.
+            A generator is returned which yields an ``AnalysisResult`` for
+            each file as soon as it has been analysed, so results do not 
+            arrive in the order of ``audio_files``. Errors, whether from
+            essentia or e.g. an unreadable file, are reported in the 
+            ``error`` attribute of each result rather than raised, so one 
+            bad file does not stop the batch.
+
+        """
+        if workers is None:
+            workers = settings.ANALYSIS_WORKERS or cpu_count()
+        audio_files = list(audio_files)
+        if workers < 2 or len(audio_files) < 2:
+            for filepath in audio_files:
+                yield self._analyse_result(filepath)
+            return
+        log.info("Analysing %d files using %d workers" 
+            % (len(audio_files), workers))
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(self._analyse_result, 
+                audio_files):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _analyse_result(self, audio_filepath):
+        """
+            Analyses a single file for ``analyse_batch``, wrapping the outcome
+            in an ``AnalysisResult``.
+
+        """
+        start = time.time()
+        try:
+            self.analyse_audio(audio_filepath)
+        except Exception, e:
+            log.error("Analysis of '%s' failed: %s" % (audio_filepath, e))
+            return AnalysisResult(audio_filepath, e, time.time() - start)
+        return AnalysisResult(audio_filepath, elapsed=time.time() - start)
+
+
+class EssentiaAnalyser(Analyser):
     """
         Is used for invoking the binary essentia analyser.
         It may be run in batch mode or for a single file.
@@ -30,22 +247,41 @@ class EssentiaAnalyser:
 
     """
 
-    def __init__(self):
+    def __init__(self, timeout=None, retries=None):
         """
             Sets the essentia binary to the path stored in settings.
+            Sets up the analysis cache, unless it has been disabled in
+            settings.
+            Each run of the binary is limited to ``timeout`` seconds, plus
+            ``ANALYSIS_TIMEOUT_PER_SECOND`` for each second of audio, and 
+            retried up to ``retries`` times if it times out or crashes, 
+            both default to the values in settings.
 
         """    
-        self.ESSENTIA_BIN = os.path.join(settings.ESSENTIA_BIN_DIR, settings.DEFAULT_ANALYSER)  
-        
-    def analyse(self, audio_files):
+        self.ESSENTIA_BIN = os.path.abspath(os.path.join(
+            settings.ESSENTIA_BIN_DIR, settings.DEFAULT_ANALYSER))
+        self.bin_id = bin_identity(self.ESSENTIA_BIN)
+        if settings.ANALYSIS_CACHE_DIR:
+            self.cache = AnalysisCache(settings.ANALYSIS_CACHE_DIR)
+        else:
+            self.cache = None
+        if timeout is None:
+            timeout = settings.ANALYSIS_TIMEOUT
+        if retries is None:
+            retries = settings.ANALYSIS_RETRIES
+        self.timeout = timeout
+        self.retries = retries
+        self.hooks = []
+
+    def add_hook(self, hook):
         """
-             Parameter is a list of audio files.
-             A generator is returned with the analysis data for each file.
+            Registers ``hook``, a callable which is passed an ``Invocation``
+            after every run of the binary. Hooks may be called from several
+            threads at once in batch mode.
 
         """
-        for filepath in audio_files:
-            yield self.analyse_audio(filepath)
-            
+        self.hooks.append(hook)
+        
     def set_bin(self, bin_name):
         """
             Allows dynamic switching of binary analysers, e.g. for analysing 
@@ -58,7 +294,8 @@ class EssentiaAnalyser:
         new_bin = os.path.join(settings.ESSENTIA_BIN_DIR, bin_name)
         if os.path.isfile(new_bin):
             log.info("Using new essentia bin: '%s'" % new_bin)
-            self.ESSENTIA_BIN = new_bin
+            self.ESSENTIA_BIN = os.path.abspath(new_bin)
+            self.bin_id = bin_identity(self.ESSENTIA_BIN)
         else:
             log.error("'%s' is not a file, keeping original: '%s'" 
                % (new_bin, self.ESSENTIA_BIN))
@@ -68,30 +305,478 @@ class EssentiaAnalyser:
             This function invokes the essentia binary.
             Reads in the output file, deletes the file 
             and returns a dictionary.
+            If this audio has already been analysed by the current binary,
+            the cached analysis is used and the binary is not invoked.
+            Otherwise a virtual unit is written to a temporary wav file for 
+            the binary.
             
         """
-    
-        #We actuallly have to be in the same directory as the streaming
-        # extracor in order to make this work....
-        current_dir = os.getcwd()
-        os.chdir(settings.ESSENTIA_BIN_DIR)
-        
-        command = [self.ESSENTIA_BIN, audio_filepath, \
-            switch_ext(audio_filepath, '.yaml')]
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, \
-        stderr = subprocess.PIPE)
-        (stdout, stderr) = process.communicate()
+        # The streaming extractor has to run from its own directory in order
+        # to find the svm models. It is launched there directly rather than
+        # changing the working directory of this process, so paths are made 
+        # absolute first.
+        audio_filepath = os.path.abspath(audio_filepath)
+        analysis_filepath = switch_ext(audio_filepath, '.yaml')
+        key = None
+        if self.cache:
+            key = self.cache.key(audio_filepath, self.bin_id)
+            if self.cache.fetch(key, analysis_filepath):
+                log.debug("Using cached analysis for '%s'" % audio_filepath)
+                return audio_filepath
+        if not is_virtual_unit(audio_filepath):
+            self._analyse_file(audio_filepath, analysis_filepath, key)
+            return audio_filepath
+        temp_filepath = export_unit(audio_filepath)
+        try:
+            self._analyse_file(temp_filepath, analysis_filepath, key)
+        finally:
+            os.remove(temp_filepath)
+        return audio_filepath
+
+    def _analyse_file(self, audio_filepath, analysis_filepath, key=None):
+        """
+            Analyses the wav file at ``audio_filepath`` with the binary into
+            ``analysis_filepath``, which is added to the cache under ``key``
+            if one is given.
+
+        """
+        command = [self.ESSENTIA_BIN, audio_filepath, analysis_filepath]
+        timeout = self.get_timeout(audio_filepath)
+        for attempt in range(1, self.retries + 2):
+            (invocation, stdout, stderr) = self._invoke(command, 
+                audio_filepath, attempt, timeout)
+            if not invocation.timed_out and invocation.returncode >= 0:
+                break
+            # Don't leave partial analysis behind for a killed run.
+            if os.path.isfile(analysis_filepath):
+                os.remove(analysis_filepath)
+            log.warn("Analysis of '%s' %s, attempt %d of %d" % (
+                audio_filepath, 'timed out' if invocation.timed_out else 
+                'crashed', attempt, self.retries + 1))
+        else:
+            if invocation.timed_out:
+                raise EssentiaError("ERROR timed out after %.0f seconds" 
+                    % timeout)
+            raise EssentiaError("ERROR killed by signal %d" 
+                % -invocation.returncode)
         log.debug('%s \n %s' % (stdout, stderr))
         pat = re.compile('ERROR.+$')
         match = pat.search(stdout)
-        
-        os.chdir(current_dir)
 
         if match:
             raise EssentiaError(match.group())
-        # Change this to return the analysis filepath!!
+        if key is not None:
+            self.cache.store(key, analysis_filepath)
+
+    def get_timeout(self, audio_filepath):
+        """
+            Returns the seconds the binary may run on ``audio_filepath``,
+            which grow with its duration so that long source files aren't
+            killed like a hung unit analysis. None if there is no limit.
+
+        """
+        if not self.timeout:
+            return None
+        try:
+            audio_file = Sndfile(audio_filepath, 'r')
+            try:
+                duration = float(audio_file.nframes) / audio_file.samplerate
+            finally:
+                audio_file.close()
+        except IOError, e:
+            log.debug("Cannot read the duration of '%s': %s" 
+                % (audio_filepath, e))
+            duration = 0
+        return self.timeout + duration * settings.ANALYSIS_TIMEOUT_PER_SECOND
+
+    def _invoke(self, command, audio_filepath, attempt, timeout=None):
+        """
+            Runs the binary once, killing it if it exceeds ``timeout``
+            seconds. Output is collected in temporary files rather than 
+            pipes, so the process can be reaped with ``os.wait4`` for its 
+            cpu time. Returns the ``Invocation``, stdout and stderr, after
+            passing the ``Invocation`` to the hooks.
+
+        """
+        invocation = Invocation(audio_filepath, attempt)
+        stdout_file = tempfile.TemporaryFile()
+        stderr_file = tempfile.TemporaryFile()
+        try:
+            start = time.time()
+            process = subprocess.Popen(command, stdout=stdout_file, 
+                stderr=stderr_file, cwd=settings.ESSENTIA_BIN_DIR)
+            # Held while the process is reaped or killed, so it is never
+            # killed once reaped, when its pid may have been reused.
+            lock = threading.Lock()
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, _kill, 
+                    (process, invocation, lock))
+                timer.start()
+            try:
+                (status, usage) = _wait4(process, lock)
+            finally:
+                if timer:
+                    timer.cancel()
+            invocation.wall_time = time.time() - start
+            invocation.cpu_time = usage.ru_utime + usage.ru_stime
+            invocation.returncode = process.returncode
+            stdout_file.seek(0)
+            stdout = stdout_file.read()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+        finally:
+            stdout_file.close()
+            stderr_file.close()
+        analysis_filepath = command[-1]
+        if os.path.isfile(analysis_filepath):
+            invocation.output_size = os.path.getsize(analysis_filepath)
+        for hook in self.hooks:
+            hook(invocation)
+        return invocation, stdout, stderr
+
+
+def _kill(process, invocation, lock):
+    """
+        Timer callback killing an analyser ``process`` which is still 
+        running. It may have finished just as the timer fired, in which 
+        case there is nothing to kill. ``_wait4`` sets the returncode of
+        the process while holding ``lock`` as it reaps it.
+
+    """
+    lock.acquire()
+    try:
+        if process.returncode is None:
+            try:
+                process.kill()
+                invocation.timed_out = True
+            except OSError:
+                pass
+    finally:
+        lock.release()
+
+def _wait4(process, lock):
+    """
+        Waits for the child ``process`` and sets its returncode, returns 
+        its status and resource usage. The child is polled rather than 
+        waited for, so that it is only reaped while holding ``lock``.
+
+    """
+    delay = 0.001
+    while True:
+        lock.acquire()
+        try:
+            try:
+                (pid, status, usage) = os.wait4(process.pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+                pid = 0
+            if pid != 0:
+                if os.WIFSIGNALED(status):
+                    process.returncode = -os.WTERMSIG(status)
+                else:
+                    process.returncode = os.WEXITSTATUS(status)
+                return status, usage
+        finally:
+            lock.release()
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+class NumpyAnalyser(Analyser):
+    """
+        An in-process analyser for units. Only the low level descriptors 
+        used for unit search are computed, directly from the samples with 
+        numpy, so there is no process to launch per unit. 
+        Like the ``EssentiaAnalyser`` the analysis is written to a .yaml 
+        file with the same filepath as the analysed .wav file, using the 
+        same descriptor names as the essentia extractor:
+         *  ``metadata.audio_properties.length``
+         *  ``metadata.audio_properties.sample_rate``
+         *  ``lowlevel.pitch``
+         *  ``lowlevel.pitch_confidence``
+         *  ``lowlevel.spectral_energy``
+         *  ``lowlevel.spectral_rms``
+        Each frame based descriptor is summarised by its mean, var, min and
+        max over the frames of the unit. The values are not on the same 
+        scale as essentia's, so ``metadata.analyser`` is set to 'numpy' and
+        ``check_analysers`` refuses to compare them with essentia units.
+
+    """
+
+    def __init__(self, frame_size=2048, hop_size=1024, min_pitch=50.0, 
+        max_pitch=1500.0):
+        """
+            Frame and hop sizes are in samples, the pitch range is in Hz.
+
+        """
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        self.min_pitch = min_pitch
+        self.max_pitch = max_pitch
+        self.window = np.hanning(self.frame_size)
+
+    def set_bin(self, bin_name):
+        """ There is no binary to switch, so this does nothing. """
+
+        log.warn("NumpyAnalyser does not use a binary, ignoring '%s'" 
+            % bin_name)
+
+    def analyse_audio(self, audio_filepath):
+        """
+            Computes the descriptors for the audio at ``audio_filepath`` and 
+            writes them to a .yaml file alongside it. An ``EssentiaError`` is
+            raised if the audio can't be read, so callers handle failures 
+            the same way for either analyser.
+
+        """
+        try:
+            (audio_data, sample_rate, file_format) = read_unit(audio_filepath)
+        except Exception, e:
+            raise EssentiaError("ERROR reading '%s': %s" % (audio_filepath, e))
+        analysis = self.get_descriptors(to_mono(audio_data), sample_rate)
+        self.write_analysis(analysis, switch_ext(audio_filepath, '.yaml'))
         return audio_filepath
 
+    def write_analysis(self, analysis, analysis_filepath):
+        """ Writes a dictionary of descriptors to a .yaml file. """
+
+        f = open(analysis_filepath, 'w')
+        try:
+            yaml.safe_dump(analysis, f, default_flow_style=False)
+        finally:
+            f.close()
+
+    def get_descriptors(self, audio_data, sample_rate):
+        """
+            Returns the nested dictionary of descriptors for a mono array of 
+            samples.
+
+        """
+        frames = self.get_frame_features(audio_data, sample_rate)
+        lowlevel = {}
+        for name in frames:
+            lowlevel[name] = summarise(frames[name])
+        return {
+            'metadata': {
+                'analyser': NUMPY_ANALYSER,
+                'audio_properties': {
+                    'length': float(len(audio_data)) / float(sample_rate),
+                    'sample_rate': float(sample_rate)
+                }
+            },
+            'lowlevel': lowlevel
+        }
+
+    def get_frame_features(self, audio_data, sample_rate):
+        """
+            Returns a dictionary of frame based features, each an array with
+            one value per frame. Audio shorter than a frame is zero padded
+            to fill one frame.
+
+        """
+        if len(audio_data) < self.frame_size:
+            audio_data = np.concatenate((audio_data, 
+                np.zeros(self.frame_size - len(audio_data))))
+        frames = get_frame_matrix(audio_data, self.frame_size, self.hop_size)
+        windowed = frames * self.window
+        power = np.abs(np.fft.rfft(windowed, axis=1)) ** 2
+        spectral_energy = power.sum(axis=1)
+        spectral_rms = np.sqrt(power.mean(axis=1))
+
+        # Pitch is taken from the autocorrelation within the allowed range of
+        # lags. The autocorrelation is computed from the zero padded spectrum
+        # and divided by that of the window, so that longer lags are not 
+        # penalised. To avoid octave errors the period is the first peak 
+        # which comes close to the highest one.
+        acf = np.fft.irfft(np.abs(np.fft.rfft(windowed, 2*self.frame_size, 
+            axis=1)) ** 2, axis=1)
+        window_acf = np.fft.irfft(np.abs(np.fft.rfft(self.window, 
+            2*self.frame_size)) ** 2)
+        min_lag = max(int(sample_rate / self.max_pitch), 1)
+        max_lag = min(int(sample_rate / self.min_pitch), self.frame_size/2)
+        lags = acf[:, min_lag:max_lag] / window_acf[min_lag:max_lag]
+        rows = np.arange(len(frames))
+        is_peak = np.zeros(lags.shape, dtype=bool)
+        is_peak[:, 1:-1] = (lags[:, 1:-1] > lags[:, :-2]) & \
+            (lags[:, 1:-1] >= lags[:, 2:])
+        is_peak &= lags >= 0.9 * lags.max(axis=1)[:, np.newaxis]
+        peaks = np.where(is_peak.any(axis=1), np.argmax(is_peak, axis=1), 
+            np.argmax(lags, axis=1))
+        energy = acf[:, 0] / window_acf[0]
+        voiced = energy > 0
+        pitch_confidence = np.zeros(len(frames))
+        pitch_confidence[voiced] = np.clip(
+            lags[rows, peaks][voiced] / energy[voiced], 0, 1)
+        pitch = np.zeros(len(frames))
+        pitch[voiced] = float(sample_rate) / (peaks[voiced] + min_lag)
+        return {
+            'pitch': pitch,
+            'pitch_confidence': pitch_confidence,
+            'spectral_energy': spectral_energy,
+            'spectral_rms': spectral_rms
+        }
+
+
+    def analyse_frames(self, audio_filepath, frames_filepath):
+        """
+            Computes the frame based features of a whole source file in a 
+            single pass and saves them, along with the sample rate, length 
+            and framing of the audio, to ``frames_filepath`` (.npz). 
+            Descriptors for any segmentation of the file can then be 
+            derived with ``aggregate`` without decoding it again. 
+            Returns the saved frame analysis.
+
+        """
+        try:
+            (audio_data, sample_rate, file_format) = wavread(audio_filepath)
+        except Exception, e:
+            raise EssentiaError("ERROR reading '%s': %s" % (audio_filepath, e))
+        audio_data = to_mono(audio_data)
+        frames = self.get_frame_features(audio_data, sample_rate)
+        frames.update({
+            'sample_rate': sample_rate, 
+            'samples': len(audio_data),
+            'frame_size': self.frame_size,
+            'hop_size': self.hop_size
+        })
+        np.savez(frames_filepath, **frames)
+        return frames
+
+    def load_frames(self, frames_filepath):
+        """
+            Loads a frame analysis saved by ``analyse_frames``. Returns 
+            None if it was computed with a different frame or hop size.
+
+        """
+        data = np.load(frames_filepath)
+        try:
+            frames = dict((name, data[name]) for name in data.files)
+        finally:
+            data.close()
+        if int(frames['frame_size']) != self.frame_size or \
+            int(frames['hop_size']) != self.hop_size:
+            return None
+        return frames
+
+    def aggregate(self, frames, boundaries):
+        """
+            Derives the descriptors of each unit given by ``boundaries``, a 
+            list of (start, length) pairs in samples, from a frame analysis
+            of the whole file. A frame belongs to the unit its centre falls
+            in, units too short to contain a frame centre take the nearest
+            frame. Returns one dictionary of descriptors per unit, in the 
+            same form as ``get_descriptors``.
+
+        """
+        sample_rate = float(frames['sample_rate'])
+        names = [name for name in frames if np.ndim(frames[name]) == 1]
+        no_frames = len(frames[names[0]])
+        if len(boundaries) == 0 or no_frames == 0:
+            return []
+        bounds = np.array(boundaries, dtype=int).reshape(-1, 2)
+        centres = np.arange(no_frames) * self.hop_size + self.frame_size / 2
+        first = np.searchsorted(centres, bounds[:, 0])
+        last = np.searchsorted(centres, bounds[:, 0] + bounds[:, 1])
+        empty = last <= first
+        nearest = np.searchsorted(centres, bounds[:, 0] + bounds[:, 1] / 2)
+        first[empty] = np.minimum(nearest[empty], no_frames - 1)
+        last[empty] = first[empty] + 1
+        counts = (last - first).astype(float)
+        # Each statistic is reduced over [first, last) by interleaving the 
+        # unit edges, only every other reduction is a unit. Units may 
+        # overlap when segmenting with a hop.
+        edges = np.column_stack((first, last)).ravel()
+        reduce = lambda ufunc, values: ufunc.reduceat(
+            np.concatenate((values, [0.0])), edges)[::2]
+        summaries = {}
+        for name in names:
+            values = frames[name].astype(float)
+            mean = reduce(np.add, values) / counts
+            var = np.maximum(reduce(np.add, values ** 2) / counts - 
+                mean ** 2, 0.0)
+            summaries[name] = {
+                'mean': mean, 
+                'var': var,
+                'min': reduce(np.minimum, values),
+                'max': reduce(np.maximum, values)
+            }
+        analysis = []
+        for index, (start, length) in enumerate(bounds):
+            lowlevel = {}
+            for name in names:
+                lowlevel[name] = dict((stat, float(summaries[name][stat][index]))
+                    for stat in summaries[name])
+            analysis.append({
+                'metadata': {
+                    'analyser': NUMPY_ANALYSER,
+                    'audio_properties': {
+                        'length': float(length) / sample_rate,
+                        'sample_rate': sample_rate
+                    }
+                },
+                'lowlevel': lowlevel
+            })
+        return analysis
+
+
+def summarise(values):
+    """
+        Summarises an array of frame ``values`` in the same way as the 
+        essentia extractor: returns a dictionary of mean, var, min and max.
+
+    """
+    return {
+        'mean': float(np.mean(values)),
+        'var': float(np.var(values)),
+        'min': float(np.min(values)),
+        'max': float(np.max(values))
+    }
+
+
+def get_analyser_name(unit_filepaths):
+    """
+        Returns the name of the analyser which analysed the units in 
+        ``unit_filepaths``, from the first with analysis, as recorded in 
+        ``metadata.analyser``, which the essentia extractor doesn't write.
+        Returns None if none of the units have been analysed.
+
+    """
+    for unit_filepath in unit_filepaths:
+        analysis_filepath = switch_ext(unit_filepath, '.yaml')
+        if os.path.isfile(analysis_filepath):
+            metadata = read_analysis(analysis_filepath).get('metadata', {})
+            return metadata.get('analyser', ESSENTIA_ANALYSER)
+    return None
+
+def check_analysers(source_units, target_units):
+    """
+        Raises an ``AnalyserMismatchError`` if the ``source_units`` and
+        ``target_units`` were analysed by different analysers.
+
+    """
+    source = get_analyser_name(source_units)
+    target = get_analyser_name(target_units)
+    if source and target and source != target:
+        raise AnalyserMismatchError("Source units were analysed by '%s' but"
+            " target units by '%s', analyse both with the same analyser" 
+            % (source, target))
+
+def get_unit_analyser(name=None):
+    """
+        Returns an instance of the analyser to use for units, as named in
+        ``settings.UNIT_ANALYSER`` unless ``name`` is given. 
+        Whole files always need the essentia extractor for their high level
+        descriptors.
+
+    """
+    analysers = {ESSENTIA_ANALYSER: EssentiaAnalyser, 
+        NUMPY_ANALYSER: NumpyAnalyser}
+    if name is None:
+        name = settings.UNIT_ANALYSER
+    return analysers[name]()
+
 
 # This function returns the magnitude of the positive spectrum from the 
 # fft frame.
@@ -116,58 +801,142 @@ get_freq_bins = lambda fft_size, sample_rate: np.array(range(1, fft_size/2)) * \
 
 class LoudnessAnalyser(object):
     """
+        Measures the energy in 8 logarithmically spaced frequency bands, 
+        from 100 Hz up to the Nyquist, for each hop of an audio file.
+        Frames are processed as a matrix, ``block_size`` frames at a time, 
+        so that the windowing, fft and band sums are whole array operations.
+
     """
 
-    def __init__(self,  hop_size=512, window_size=1024):
+    def __init__(self,  hop_size=512, window_size=1024, block_size=128):
         """
         """
         self.window_size = window_size
         self.fft_size = next_pow2(self.window_size)
         self.hop_size = hop_size
+        self.block_size = block_size
         self.window = np.hamming(self.window_size)
 
     def get_loudness(self, filepath):
         """
+            Returns an array of log band energies with one row per hop of
+            the audio at ``filepath`` and one column per band. Rows at the 
+            end which do not correspond to a complete frame are left at the
+            floor value.
+
+        """
+        blocks = list(self.stream_loudness(filepath))
+        if len(blocks) == 0:
+            return np.zeros((0, 8), dtype='single')
+        return np.concatenate(blocks)
+
+    def stream_loudness(self, filepath):
+        """
+            Generator version of ``get_loudness`` for long recordings.
+            The file is read ``block_size`` hops at a time and the log band
+            energies of each block are yielded as soon as they have been 
+            computed. The samples of the last, incomplete frame of a block 
+            are carried over to the next one, so frames overlap across block
+            boundaries exactly as they do when the whole file is read. 
+            Memory use depends on ``block_size``, not on the file length.
+
+        """
+        audio_file = Sndfile(filepath, 'r')
+        try:
+            self.sample_rate = audio_file.samplerate
+            band_masks = self.get_band_masks(self.sample_rate)
+            no_hops = audio_file.nframes / self.hop_size
+            read_size = self.block_size * self.hop_size
+            remaining = audio_file.nframes
+            carry = np.zeros(0)
+            produced = 0
+            while remaining > 0:
+                samples = audio_file.read_frames(min(read_size, remaining))
+                remaining -= len(samples)
+                audio_data = np.concatenate((carry, to_mono(samples)))
+                frames = self.get_frame_matrix(audio_data)[:no_hops-produced]
+                if len(frames) > 0:
+                    energy_bands = self.get_band_energies(frames, 
+                        band_masks).astype('single')
+                    #Take the log of the energy values            
+                    yield 10*np.log10(energy_bands + 0.0001)
+                    produced += len(frames)
+                carry = audio_data[len(frames)*self.hop_size:]
+            # Hops at the end which can't fill a frame get the floor value.
+            if no_hops > produced:
+                energy_bands = np.zeros((no_hops - produced, 
+                    band_masks.shape[1]), dtype='single')
+                yield 10*np.log10(energy_bands + 0.0001)
+        finally:
+            audio_file.close()
+
+    def write_loudness(self, filepath, loudness_filepath):
+        """
+            Streams the log band energies of the audio at ``filepath`` to
+            ``loudness_filepath`` as raw single precision values, one block 
+            at a time. The result can be read back with 
+            ``np.fromfile(loudness_filepath, 'single').reshape(-1, 8)``.
+
+        """
+        out = open(loudness_filepath, 'wb')
+        try:
+            for energy in self.stream_loudness(filepath):
+                energy.tofile(out)
+        finally:
+            out.close()
+
+    def get_band_masks(self, sample_rate, lowband=100.0, no_bands=8):
+        """
+            Returns a matrix with a row for each positive frequency bin and a 
+            column for each band, holding 1 where the bin falls inside the 
+            band (edges included) and 0 elsewhere.
+
         """
-        
-        
-        # Read in the file and extract samples, sample rate and format
-        filepath = filepath
-        (audio_data, self.sample_rate, file_format) = wavread(filepath)
-        
         # Set the low band and build our logarithmic frequency ranges up as
         # far as the Nyquist.
-        lowband = 100.0
-        no_bands = 8.0
-        freq_bands = np.concatenate((np.array([0.0]), np.array(\
-            lowband * np.power((float(self.sample_rate)/2.0/lowband), \
-                np.arange(no_bands)/(no_bands - 1)))
+        freq_bands = np.concatenate((np.array([0.0]), 
+            lowband * np.power((float(sample_rate)/2.0/lowband), 
+                np.arange(no_bands)/float(no_bands - 1))
         ))
-        print ("Freq_bands: %s" % freq_bands )
-        # Define a function to calculate the energy
-        calc_energy = lambda mag: np.power(sum(mag), 2)
-        
+        log.debug("Freq_bands: %s" % freq_bands)
         # Get centre frequency of each bin in Hz    
-        freq_bins = get_freq_bins(self.fft_size, self.sample_rate)
-        # Create a container for the value in each band at each hop and then..
-        # loop!
-        energy_bands = np.zeros((len(audio_data)/self.hop_size, no_bands), dtype='single')
-        for index, frame in enumerate(self.get_frames(audio_data)):
-            fft_frame = self.fft(frame)
-            mag = pos_spec(fft_frame.astype('single'))
-            for ind, freq in enumerate(freq_bands):
-                if ind == 0:
-                    prev_freq = freq
-                else:
-                    #print "Calculating energy of band: %f to %f" \
-                        #% (prev_freq, freq)
-                    energy_bands[index, ind-1] = \
-                        calc_energy(find_mags(mag, freq_bins, prev_freq, freq))
-                    prev_freq = freq
-        
-        #Take the log of the energy values            
-        energy = 10*np.log10(energy_bands + 0.0001)
-        return energy
+        freq_bins = get_freq_bins(self.fft_size, sample_rate)[:, np.newaxis]
+        masks = (freq_bins >= freq_bands[np.newaxis, :-1]) & \
+            (freq_bins <= freq_bands[np.newaxis, 1:])
+        return masks.astype('double')
+
+    def get_band_energies(self, frames, band_masks):
+        """
+            Takes a matrix of ``frames``, one frame per row, and returns the
+            energy in each band of ``band_masks`` for every frame.
+            This is the matrix equivalent of ``fft``, ``pos_spec`` and 
+            ``find_mags`` applied frame by frame.
+
+        """
+        half = self.window_size/2
+        # Window and center the frames in one pass. The two samples which 
+        # the centring drops are zeroed.
+        centred_frames = np.empty((len(frames), self.window_size))
+        np.multiply(frames[:, half:self.window_size-1], 
+            self.window[half:self.window_size-1], 
+            out=centred_frames[:, 0:half-1])
+        np.multiply(frames[:, 0:half-1], self.window[0:half-1], 
+            out=centred_frames[:, half:self.window_size-1])
+        centred_frames[:, half-1] = 0
+        centred_frames[:, self.window_size-1] = 0
+        spectra = np.fft.rfft(centred_frames, self.fft_size, axis=1)
+        # Casting the complex spectrum to single precision keeps only the
+        # real part, which is what ``pos_spec`` has always been given. 
+        mags = np.abs(spectra.real[:, 0:self.fft_size/2 - 1].astype('single'))
+        return np.power(np.dot(mags, band_masks), 2)
+
+    def get_frame_matrix(self, audio_data):
+        """
+            Returns every complete frame of ``audio_data`` as the rows of a 
+            matrix, see ``hmosaic.utils.get_frame_matrix``.
+
+        """
+        return get_frame_matrix(audio_data, self.window_size, self.hop_size)
 
     def get_frames(self, audio_data):
         """ 
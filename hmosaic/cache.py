@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+Caches used across hmosaic.
+
+A process wide, memory bounded cache of loaded gaia datasets and of the
+distances and views created for them, so that a long running process like
+the mosaicing daemon only loads a dataset from disk once. Entries are
+evicted least recently used first once their estimated size exceeds
+``GAIA_CACHE_SIZE`` megabytes. An entry can depend on another, e.g. a
+view on its dataset, and is evicted along with it.
+
+A content addressed cache on disk, for results computed from the contents
+of a file such as its analysis. Entries are keyed on a hash of the file, 
+so they are shared by identical files and outlive the process. The cache is
+pruned to ``CONTENT_CACHE_SIZE`` megabytes, least recently used first, by
+``ContentCache.prune``.
+
+"""
+
+# Standard library imports
+import os
+import errno
+import hashlib
+import threading
+
+# hmosaic package imports
+from hmosaic import log, settings
+from hmosaic.utils import file_hash, make_dirs, atomic_write
+
+
+class LRUCache(object):
+    """
+        A cache holding at most ``max_bytes`` worth of entries. Each entry
+        has a key, a size in bytes and optionally a ``stamp``, e.g. the
+        modification time of the file the value was loaded from. An entry
+        is only returned for the stamp it was stored with.
+
+    """
+
+    def __init__(self, max_bytes):
+        """
+            ``max_bytes`` of None or 0 disables the cache.
+
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = {}
+        self._keys = {}
+        self._clock = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, stamp=None):
+        """
+            Returns the value stored for ``key``, None if there is none.
+            An entry stored with a different ``stamp`` is removed.
+
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry['stamp'] != stamp:
+                log.debug("Dropping stale cache entry %s" % (key,))
+                self.remove(key)
+                return None
+            self._clock += 1
+            entry['used'] = self._clock
+            return entry['value']
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, size=0, stamp=None, parent=None):
+        """
+            Stores ``value`` for ``key``, evicting the least recently used
+            entries if the cache grows too big. The entry is removed
+            whenever the entry for the ``parent`` key is. Returns
+            ``value``.
+
+        """
+        if not self.max_bytes:
+            return value
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self.remove(key)
+            if parent is not None and parent not in self._entries:
+                return value
+            self._clock += 1
+            if parent is not None:
+                self._entries[parent]['used'] = self._clock
+            self._entries[key] = {'value': value, 'size': size,
+                'stamp': stamp, 'used': self._clock, 'children': set()}
+            self._keys[id(value)] = key
+            if parent is not None:
+                self._entries[parent]['children'].add(key)
+            self.size += size
+            self._evict(keep=key)
+            return value
+        finally:
+            self._lock.release()
+
+    def key_of(self, value):
+        """
+            Returns the key under which ``value`` is stored, None if it
+            isn't in the cache.
+
+        """
+        self._lock.acquire()
+        try:
+            key = self._keys.get(id(value))
+            if key is not None and self._entries[key]['value'] is value:
+                return key
+            return None
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        """ Removes the entry for ``key`` and the entries depending on it. """
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            if self._keys.get(id(entry['value'])) == key:
+                del self._keys[id(entry['value'])]
+            self.size -= entry['size']
+            for child in entry['children']:
+                self.remove(child)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ Removes all entries. """
+
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self._keys = {}
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _evict(self, keep=None):
+        """
+            Removes the least recently used entries until the cache fits,
+            but never the entry for ``keep``, even if it is too big itself.
+
+        """
+        while self.size > self.max_bytes:
+            candidates = [(entry['used'], k) for (k, entry) in
+                self._entries.items() if k != keep]
+            if len(candidates) == 0:
+                break
+            (used, key) = min(candidates)
+            log.debug("Evicting cache entry %s" % (key,))
+            self.remove(key)
+
+
+# The cache of gaia datasets, distances and views shared by the process
+gaia_cache = LRUCache(settings.GAIA_CACHE_SIZE and
+    settings.GAIA_CACHE_SIZE * 1024 * 1024)
+
+
+class ContentCache(object):
+    """
+        A content addressed store of files with the extension ``ext``.
+        Entries are keyed on a hex digest and spread over subdirectories
+        by its first two characters, beside an index of the content hash
+        of each file seen, by its path, size and modification time, so
+        that a file is only read to be hashed once. Each entry of the 
+        index holds the content hash and the path of the file, so that it
+        can be pruned once the file changes. The cache looks like this:
+
+            location
+                ---> 3f
+                    ---> 3f0c...e1.yaml
+                ---> a7
+                    ---> a712...09.yaml
+                ---> hashes
+                    ---> 5b
+                        ---> 5b91...c4
+
+    """
+
+    def __init__(self, location, ext):
+        """
+            The cache directory at ``location`` is created if needed.
+            ``prune`` keeps it to ``settings.CONTENT_CACHE_SIZE``.
+
+        """
+        self.location = os.path.abspath(location)
+        self.ext = ext
+        self.max_bytes = settings.CONTENT_CACHE_SIZE and \
+            settings.CONTENT_CACHE_SIZE * 1024 * 1024
+        make_dirs(self.location)
+
+    def get_filepath(self, key):
+        """ Returns the path at which the entry for ``key`` is stored. """
+
+        return os.path.join(self.location, key[:2], key + self.ext)
+
+    def contains(self, key):
+        """ Returns True if there is an entry for ``key``. """
+
+        return os.path.isfile(self.get_filepath(key))
+
+    def lookup(self, key):
+        """
+            Returns the path of the entry for ``key``, None if there is 
+            none. The entry is marked as used, so that ``prune`` evicts it
+            last.
+
+        """
+        filepath = self.get_filepath(key)
+        if not os.path.isfile(filepath):
+            return None
+        try:
+            os.utime(filepath, None)
+        except OSError:
+            pass
+        return filepath
+
+    def hash_file(self, filepath):
+        """
+            Returns the content hash of the file at ``filepath``, only 
+            reading the file if it has been modified since it was last
+            hashed.
+
+        """
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        stamp = (stat.st_size, stat.st_mtime)
+        content_hash = _file_hashes.get(filepath, stamp)
+        if content_hash is not None:
+            return content_hash
+        stat_id = _stat_id(filepath, stat)
+        index_filepath = os.path.join(self.location, 'hashes', stat_id[:2], 
+            stat_id)
+        if os.path.isfile(index_filepath):
+            content_hash = _read_hash_entry(index_filepath)[0]
+        if not content_hash:
+            content_hash = file_hash(filepath)
+            self._write(index_filepath, 
+                lambda f: f.write('%s\n%s' % (content_hash, filepath)))
+        return _file_hashes.put(filepath, content_hash, 
+            len(filepath) + len(content_hash), stamp)
+
+    def write(self, key, write_entry):
+        """
+            Stores the entry for ``key``, which ``write_entry`` writes to
+            the open file it is passed.
+
+        """
+        self._write(self.get_filepath(key), write_entry)
+
+    def prune(self):
+        """
+            Removes the entries of the index of file hashes whose file has
+            changed or gone since it was hashed, then the least recently
+            used entries until the cache holds at most ``max_bytes``.
+            Safe to run while other processes use the cache, though an
+            entry they have just looked up may be evicted.
+
+        """
+        stale = 0
+        for (dirpath, dirnames, filenames) in os.walk(
+            os.path.join(self.location, 'hashes')):
+            for stat_id in filenames:
+                index_filepath = os.path.join(dirpath, stat_id)
+                (content_hash, filepath) = _read_hash_entry(index_filepath)
+                try:
+                    current = filepath and \
+                        _stat_id(filepath, os.stat(filepath)) == stat_id
+                except OSError:
+                    current = False
+                if not current:
+                    _remove(index_filepath)
+                    stale += 1
+        if stale:
+            log.info("Pruned %d stale file hashes from '%s'" % (stale, 
+                self.location))
+        if not self.max_bytes:
+            return
+        entries = []
+        for name in os.listdir(self.location):
+            directory = os.path.join(self.location, name)
+            if name == 'hashes' or not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                if not filename.endswith(self.ext):
+                    continue
+                filepath = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filepath))
+        size = sum(entry_size for (used, entry_size, filepath) in entries)
+        evicted = 0
+        for (used, entry_size, filepath) in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            _remove(filepath)
+            size -= entry_size
+            evicted += 1
+        if evicted:
+            log.info("Evicted %d entries from '%s', %d bytes left" % (
+                evicted, self.location, size))
+
+    def _write(self, filepath, write_entry):
+        """
+            Writes ``filepath`` with ``atomic_write``, so concurrent readers
+            never see a partial file.
+
+        """
+        make_dirs(os.path.dirname(filepath))
+        atomic_write(filepath, write_entry)
+
+
+def _stat_id(filepath, stat):
+    """
+        Returns the key of ``filepath`` in the index of file hashes, from
+        its ``stat``.
+
+    """
+    return hashlib.sha1('%s:%d:%r' % (filepath, stat.st_size, 
+        stat.st_mtime)).hexdigest()
+
+def _read_hash_entry(index_filepath):
+    """
+        Returns the content hash and file path held by an entry of the 
+        index of file hashes, either may be None. Entries written before
+        the path was stored only hold the hash.
+
+    """
+    try:
+        f = open(index_filepath)
+        try:
+            lines = f.read().split('\n', 1)
+        finally:
+            f.close()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return (None, None)
+    content_hash = lines[0].strip() or None
+    if len(lines) < 2:
+        return (content_hash, None)
+    return (content_hash, lines[1])
+
+def _remove(filepath):
+    """ Removes ``filepath``, unless another process already has. """
+
+    try:
+        os.remove(filepath)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+# Content hashes of the files hashed by this process, by filepath and
+# stamped with their size and modification time, up to about a megabyte
+_file_hashes = LRUCache(1024 * 1024)
@@ -10,13 +10,16 @@ from OSC import OSCServer, OSCMessage, OSCClient, OSCBundle
 
 # Project imports
 from hmosaic import log, settings
-from hmosaic.analyse import EssentiaAnalyser, EssentiaError
+from hmosaic.analyse import EssentiaAnalyser, EssentiaError, get_unit_analyser
+from hmosaic.analyse import check_analysers, AnalyserMismatchError
 from hmosaic.models import Mosaic, MosaicUnit
 from hmosaic.corpus import FileCorpusManager, FileNotFoundException, CorpusDoesNotExistException
 from hmosaic.utils import switch_ext, wav_timestamp, calc_chop_from_bpm
 from hmosaic.utils import secs_to_samps, timestretch
 from hmosaic.scripts import analyse_corpus
 from hmosaic.scripts.createHighLevelChops import process_corpus_highlevel
+from hmosaic.shards import get_view
+from hmosaic.cache import gaia_cache
 
 
 def extract_from_list(func):
@@ -251,13 +254,11 @@ class HighLevelControl(object):
             log.error("Source corpus has not been selected. Doing nothing...")
             return False
         file_list = self.source_corpus.list_audio_units(chop=self.chop)
-        analyser = EssentiaAnalyser()
-        for audio_file in file_list:
-            try:
-                analyser.analyse_audio(audio_file)
-            except EssentiaError, e:
+        analyser = get_unit_analyser()
+        for result in analyser.analyse_batch(file_list):
+            if result.error:
                 log.error("Essentia threw an error, skipping this one: '%s'" \
-                    % audio_file)
+                    % result.filepath)
 
 ###############################################################################
 # TARGET RELATED FUNCTIONS
@@ -319,12 +320,12 @@ class HighLevelControl(object):
         )
         # Analyse the units
         log.debug("Analysing target units")        
-        for audio in self.target_corpus.list_audio_units(
-            audio_filename=self.target.filepath, chop=self.target_chop):
-            try:
-                self.analyser.analyse_audio(audio)
-            except Exception, e:
-                log.error("Exception occurred analysing target units: %s" % e)
+        for result in get_unit_analyser().analyse_batch(
+            self.target_corpus.list_audio_units(
+                audio_filename=self.target.filepath, chop=self.target_chop)):
+            if result.error:
+                log.error("Exception occurred analysing target units: %s" 
+                    % result.error)
                 log.warn("Assume error is due to silence and ignore...")
         
         # Perform high level processing of target if appropriate.
@@ -723,6 +724,16 @@ class HighLevelControl(object):
         if not self.target:
             log.error("Target has not been set !!! ")
             return None
+
+        # Descriptors of different analysers can't be compared.
+        try:
+            check_analysers(self.source_corpus.list_audio_units(chop=self.chop),
+                self.target_corpus.list_audio_units(
+                    audio_filename=self.target.filepath, 
+                    chop=getattr(self, 'target_chop', self.chop)))
+        except AnalyserMismatchError, e:
+            log.error(e)
+            return None
             
 
         # Create a temporary file for the mosaic audio
@@ -759,8 +770,7 @@ class HighLevelControl(object):
                 )
                 hdb = self.source_corpus.get_gaia_unit_db(chop='highlevel_%s' % self.chop)
                 
-            distance = self._get_distance(hdb, 'highlevel')
-            v = View(hdb, distance)
+            v = self._get_view(hdb, 'highlevel')
             results = {}
             for f in units:
                 p = Point()
@@ -817,7 +827,7 @@ class HighLevelControl(object):
                     index += 1
         else:
             sds = self.source_corpus.get_gaia_unit_db(chop=self.chop)
-            sv = View(sds, self._get_distance(sds))
+            sv = self._get_view(sds)
         
             # Loop through target units and create mosaic 
             for index, unit in enumerate(self.target_corpus.list_audio_units(\
@@ -921,25 +931,53 @@ class HighLevelControl(object):
             default = get_low_level_distance
             #db = self.source_corpus.get_gaia_unit_db(chop=self.chop)
             
+        # Distances for a cached db are cached along with it.
+        key = ('distance', gaia_cache.key_of(db), ctype, 
+            repr(sorted(constraints.items())), 
+            repr(sorted(self.constraints.items())))
+        if key[1] is not None:
+            distance = gaia_cache.get(key)
+            if distance is not None:
+                return distance
         
         # If the desired constraints are empty then create the defaults.
         if len(constraints) == 0:
             distance = default(db)
         else:  
             distances = {}        
-            for key in self.constraints.keys():
-                distances.update({key: { 'distance': 'euclidean',
+            for name in self.constraints.keys():
+                distances.update({name: { 'distance': 'euclidean',
                               'params': { 'descriptorNames': 
-                                  key
+                                  name
                                },
-                               'weight': self.constraints[key] 
+                               'weight': self.constraints[name] 
                              }})
         
             log.debug("Similarity search distances are : %s, type is %s" % (distances, ctype))  
             distance = MetricFactory.create('linearcombination', db.layout(), \
                  distances)
+        if key[1] is not None:
+            gaia_cache.put(key, distance, parent=key[1])
         return distance
 
+    def _get_view(self, db, ctype='lowlevel'):
+        """
+            Returns a view for searching ``db`` with the distance for 
+            ``ctype``. Views on a cached db are cached along with it, so
+            they are only created once for the same constraints.
+
+        """
+        distance = self._get_distance(db, ctype)
+        distance_key = gaia_cache.key_of(distance)
+        if distance_key is not None:
+            view = gaia_cache.get(('view', distance_key))
+            if view is not None:
+                return view
+        view = get_view(db, distance)
+        if distance_key is not None:
+            gaia_cache.put(('view', distance_key), view, parent=distance_key)
+        return view
+
     def _get_info(self):
         """
             Builds a dictionary of information, relating to the current state
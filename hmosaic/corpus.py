@@ -9,23 +9,37 @@ implemented.
 """
 
 # Standard library imports
-import os, shutil, re, sys
+import os, shutil, re, sys, hashlib
+import json
 from glob import glob
 
 # Third party library imports
 from scikits.audiolab import wavread, wavwrite
+import numpy as np
 import yaml
 
 # hmosaic package imports
 from hmosaic import log
-from hmosaic.utils import to_mono, switch_ext, get_directories
-from hmosaic.utils import get_files_recursive, wav_timestamp
-from hmosaic.utils import most_recent_first
+from hmosaic.utils import to_mono, to_float, switch_ext, get_directories
+from hmosaic.utils import get_files_recursive
+from hmosaic.utils import most_recent_first, make_dirs, atomic_write
+from hmosaic.utils import write_unit_index, get_unit_index, list_virtual_units
 from hmosaic.segment import NoteOnsetSegmenter, AudioSegmenter
-from hmosaic.settings import SOURCE_REPO
+from hmosaic.segment import StreamingOnsetSegmenter
+from hmosaic.models import SegmentAudio
+from hmosaic.analyse import NumpyAnalyser
+from hmosaic.store import AnalysisStore, FeatureMatrix
+from hmosaic.manifest import JobManifest
+from hmosaic.cache import gaia_cache
+from hmosaic.settings import SOURCE_REPO, STREAMING_ONSETS, VIRTUAL_UNITS
+from hmosaic.settings import GAIA_SHARD_SIZE
 from hmosaic.scripts import segment_corpus, analyse_corpus
 from hmosaic.scripts import convertAudio as ca
 
+# Normalised descriptor values this close to the limits of [0, 1] are taken
+# to be at the limits.
+GAIA_RANGE_TOLERANCE = 1e-6
+
 ###############################################################################
 # ABSTRACT CORPUS RELATED BASE CLASSES
 ###############################################################################
@@ -115,6 +129,14 @@ class Corpus(object):
             
         """
         
+    def aggregate_units(self, audio_filepath, chop=500, hop=None, 
+        onset_weights={}, aubio=False):
+        """
+            Writes the analysis of each unit of ``audio_filepath`` for the 
+            given segmentation, without analysing the units themselves.
+            
+        """
+
     def save_marked_audio(self, name):
         """
             Returns the audio file requested.
@@ -237,13 +259,27 @@ class FileCorpus:
        It is recommended to keep these Datasets relatively small 
        e.g. 15000 units.
        Performance issues have been encountered using larger DataSets 
-       (> 30000 units)
+       (> 30000 units), so larger chops can be split into shards, see 
+       ``GAIA_SHARD_SIZE``.
        A file corpus looks like this
             
             corpus_name
                 ---> unit_ds_onsets.db
                 ---> unit_ds_500.db
                 ---> unit_ds_1000.db
+                ---> unit_ds_1000.raw.db
+                ---> unit_ds_1000.json
+                ---> unit_ds_1000.history
+                ---> unit_ds_2000.json
+                ---> unit_ds_2000.history
+                ---> unit_ds_2000.shards.json
+                ---> unit_ds_2000.shard_000.db
+                ---> unit_ds_2000.shard_001.db
+                ---> units_500.store
+                ---> features_500.npy
+                ---> features_500.names.npy
+                ---> features_500.units.npy
+                ---> features_500.json
                 ---> audio1.wav
                 ---> audio1.yaml
                 ---> audio1
@@ -262,6 +298,21 @@ class FileCorpus:
                         ---> 3_1.yaml
                         ---> 4_2.wav
                         ---> 4_2.yaml
+                ---> audio2.wav
+                ---> audio2
+                    ---> unit_index.json
+                    ---> 500
+                        ---> units.index.npz
+                        ---> 0000000.yaml
+                        ---> 0000001.yaml
+
+       The units of audio2 are virtual: the index holds the start and length
+       of each unit in audio2.wav, and units named '0000000.wav' etc. are 
+       read from there by ``hmosaic.utils.read_unit``.
+       Each unit directory has a unit_index.json listing the units of each
+       chop, so units are listed without walking the chop directories. A 
+       chop is indexed again whenever its directory has changed since it 
+       was indexed.
 
     """
     
@@ -279,6 +330,8 @@ class FileCorpus:
         self.location = os.path.abspath(filepath)
         # hardcoded aubio length for now.
         self.aubio_length = 0.2
+        # Unit indexes which have been read, by unit directory.
+        self._unit_indexes = {}
                               
 ###############################################################################
 # FILESYSTEM RELATED FUNCTIONS - STORAGE, MANAGEMENT AND RETRIEVAL OF AUDIO
@@ -307,6 +360,8 @@ class FileCorpus:
         log.debug("Processing '%s' prior to adding to corpus" % audio_filepath)
         audio_array = self._process_file(audio_filepath)
         wavwrite(audio_array, file_dest, 44100)
+        # Units left behind by an earlier file of the same name are stale.
+        self._remove_unit_index(self._get_unit_dir(file_dest))
         log.debug(" '%s' stored in corpus, returning new path: '%s'" 
             % (audio_filepath, file_dest))
     
@@ -327,9 +382,14 @@ class FileCorpus:
         except FileNotFoundException, e:
             log.error("Could not find '%s' in the source corpus: '%s'. Doing nothing."
                 % (filename, e))
-        os.remove(filename)
+            return
+        filepath = os.path.join(self.location, filename)
+        os.remove(filepath)
         log.debug("Removed '%s' from corpus" % filename)
-        shutil.remove(switch_ext(filename, ''))
+        unit_dir = self._get_unit_dir(filepath)
+        self._remove_unit_index(unit_dir)
+        if os.path.isdir(unit_dir):
+            shutil.rmtree(unit_dir)
         log.debug("Removed all units for '%s' from corpus" % filename)
 
 
@@ -347,6 +407,7 @@ class FileCorpus:
     def list_audio_units(self, audio_filename=None, chop=None):
         """
             Return full filepaths for all units
+            The units are read from the unit index of each unit directory.
         """        
          
         
@@ -354,28 +415,65 @@ class FileCorpus:
             audio_dir = switch_ext(audio_filename, '')
             self._check_segment_exists(audio_dir)
             if chop:
-                print "Chop dir has been specified: '%s'" % chop
+                log.debug("Chop dir has been specified: '%s'" % chop)
                 chop_dir = os.path.join(audio_dir, str(chop))
                 self._check_segment_exists(chop_dir)
-                return get_files_recursive(os.path.join(self.location, chop_dir))
+                return self._get_chop_units(
+                    os.path.join(self.location, chop_dir))
             else:
-               return get_files_recursive(os.path.join(self.location, audio_dir)) # Write a function to do this.                  
+                filepaths = []
+                for chop_dir in get_directories(
+                    os.path.join(self.location, audio_dir)):
+                    filepaths.extend(self._get_chop_units(chop_dir))
+                filepaths.sort()
+                return filepaths
         else: 
             filepaths = []
             
             if chop:
                 for audio_dir in self._list_segments():
-                    for chop_dir in get_directories(audio_dir):
-                        if os.path.basename(chop_dir) == str(chop):
-                            for filepath in get_files_recursive(chop_dir):
-                                filepaths.append(filepath)
+                    chop_dir = os.path.join(audio_dir, str(chop))
+                    if os.path.isdir(chop_dir):
+                        filepaths.extend(self._get_chop_units(chop_dir))
             else:
                 for audio_dir in self._list_segments():
-                    for filepath in get_files_recursive(audio_dir):
-                        filepaths.append(filepath)
+                    for chop_dir in get_directories(audio_dir):
+                        filepaths.extend(self._get_chop_units(chop_dir))
                
             filepaths.sort()         
             return filepaths
+
+    def check_unit_index(self, repair=True):
+        """
+            Compares the unit index of every unit directory with the units
+            actually found in its chop directories. Returns the chop 
+            directories whose index is wrong, after indexing them again if
+            ``repair`` is True.
+
+        """
+        inconsistent = []
+        for audio_dir in self._list_segments():
+            index = self._load_unit_index(audio_dir)
+            chop_dirs = get_directories(audio_dir)
+            chops = set(os.path.basename(d) for d in chop_dirs)
+            for chop in set(index['chops']) - chops:
+                log.warn("Unit index of '%s' lists missing chop '%s'" 
+                    % (audio_dir, chop))
+                inconsistent.append(os.path.join(audio_dir, chop))
+            for chop_dir in chop_dirs:
+                entry = index['chops'].get(os.path.basename(chop_dir))
+                units = self._list_units(chop_dir)
+                if entry is None or \
+                    self._entry_units(chop_dir, entry) != units:
+                    log.warn("Unit index of '%s' is out of date" % chop_dir)
+                    inconsistent.append(chop_dir)
+                    if repair:
+                        self._index_chop(chop_dir, units)
+            if repair:
+                for chop in set(index['chops']) - chops:
+                    del index['chops'][chop]
+                self._save_unit_index(audio_dir, index)
+        return inconsistent
             
        
     def get_filepath(self, filename):
@@ -433,13 +531,20 @@ class FileCorpus:
 # SEGMENTATION RELATED FUNCTIONS - MARKING ONSETS, CREATING UNITS
 ###############################################################################          
   
-    def segment_audio(self, audio_filepath, chop=500, hop=None, onset_weights={}, aubio=False):
+    def segment_audio(self, audio_filepath, chop=500, hop=None, onset_weights={}, aubio=False,
+        virtual=None):
         """
             Takes an audio file and segments it according to the chop value
             (milliseconds).
             A subfolder is created, same name as the audio file, inside this
             folder, we have another folder with the chop time and the units 
             are held in there.
+            ``chop`` may also be a list of chop values, or (chop, hop) 
+            pairs, in which case every segmentation is made from a single
+            read of the audio. ``hop`` applies to chops given without one.
+            If ``virtual`` is True only an index of the unit boundaries is
+            written, rather than a wav file per unit. It defaults to 
+            VIRTUAL_UNITS in settings.
             
         """
         
@@ -448,27 +553,120 @@ class FileCorpus:
         if not os.path.dirname(audio_filepath) == self.location:
             FileNotFoundException("Audio: '%s' is not in the corpus: '%s'" \
                 % (audio_filepath, self.location))
-        segments_dir = self._make_segments_dir(audio_filepath, chop)
-        if chop == 'onsets':
-            segmenter = NoteOnsetSegmenter(aubio=aubio)
-            segmenter.aubio_length = self.aubio_length
-            if len(onset_weights) > 0:
-                segmenter.set_weights(onset_weights)
-        else:
-            segmenter = AudioSegmenter(chop=chop, hop=hop)
-        
-        for index, unit in enumerate(segmenter.segment(audio_filepath)):
-            log.debug("Length of unit is: %f" % unit.length)
-            filepath = os.path.join(segments_dir, '%07d.wav' % (index))
-            wavwrite(unit.data, filepath, unit.sample_rate)
-            log.debug("Successfully written '%07d.wav' to '%s'" % 
-                (index, segments_dir) )
+        if virtual is None:
+            virtual = VIRTUAL_UNITS
+        if not isinstance(chop, list):
+            chop = [chop]
+        audio = None
+        for scheme in chop:
+            if isinstance(scheme, tuple):
+                (scheme_chop, scheme_hop) = scheme
+            else:
+                (scheme_chop, scheme_hop) = (scheme, hop)
+            segments_dir = self._make_segments_dir(audio_filepath, scheme_chop)
+            segmenter = self._get_segmenter(scheme_chop, scheme_hop, 
+                onset_weights, aubio)
+            if virtual:
+                boundaries = segmenter.get_boundaries(audio_filepath)
+                no_units = write_unit_index(segments_dir, audio_filepath, 
+                    boundaries)
+                log.debug("Indexed %d virtual units in '%s'" 
+                    % (no_units, segments_dir))
+                self._index_chop(segments_dir, count=no_units)
+                continue
+            if isinstance(segmenter, StreamingOnsetSegmenter):
+                # Each unit is written as soon as it is found, so the file
+                # is never held in memory as a whole.
+                no_units = 0
+                for unit in segmenter.segment(audio_filepath):
+                    filepath = os.path.join(segments_dir, '%07d.wav' 
+                        % (no_units))
+                    wavwrite(unit.data, filepath, unit.sample_rate)
+                    no_units += 1
+                log.debug("Successfully streamed %d units to '%s'" 
+                    % (no_units, segments_dir))
+                self._index_chop(segments_dir, count=no_units)
+                continue
+            if audio is None:
+                audio = SegmentAudio(audio_filepath)
+                audio_data = audio.audio_array
+                if audio_data.ndim > 1:
+                    audio_data = to_mono(to_float(audio_data))
+            # Onsets are detected in the audio already read for slicing.
+            boundaries = segmenter.get_boundaries(audio_filepath, audio_data)
+            for index, (start, length) in enumerate(boundaries):
+                filepath = os.path.join(segments_dir, '%07d.wav' % (index))
+                wavwrite(audio_data[start:start + length], filepath, 
+                    audio.sample_rate)
+            log.debug("Successfully written %d units to '%s'" 
+                % (len(boundaries), segments_dir))
+            self._index_chop(segments_dir, count=len(boundaries))
                 
 
+    def aggregate_units(self, audio_filepath, chop=500, hop=None, 
+        onset_weights={}, aubio=False):
+        """
+            Writes the analysis of each unit of ``audio_filepath`` for the 
+            given segmentation, without analysing the units themselves. 
+            The frame analysis of the whole file is computed once and kept
+            in the unit directory, so that each further ``chop`` only costs
+            an aggregation pass. The .yaml files are numbered like the .wav
+            files written by ``segment_audio`` for the same arguments, or 
+            like virtual units if there are no .wav files.
+            Returns the list of analysis filepaths.
+
+        """
+        self._check_exists(audio_filepath)
+        audio_filepath = self.get_filepath(audio_filepath)
+        frames = self.get_frame_analysis(audio_filepath)
+        segmenter = self._get_segmenter(chop, hop, onset_weights, aubio)
+        boundaries = segmenter.get_boundaries(audio_filepath)
+        segments_dir = os.path.join(self._get_unit_dir(audio_filepath), 
+            str(chop))
+        make_dirs(segments_dir)
+        count = None
+        if len(glob(os.path.join(segments_dir, '*.wav'))) == 0:
+            # Without wav files the units are indexed as virtual units, so 
+            # the analysis always has audio to go with it.
+            count = write_unit_index(segments_dir, audio_filepath, boundaries)
+        analyser = NumpyAnalyser()
+        filepaths = []
+        for index, analysis in enumerate(analyser.aggregate(frames, boundaries)):
+            filepath = os.path.join(segments_dir, '%07d.yaml' % index)
+            analyser.write_analysis(analysis, filepath)
+            filepaths.append(filepath)
+        log.debug("Aggregated analysis of %d units in '%s'" 
+            % (len(filepaths), segments_dir))
+        self._index_chop(segments_dir, count=count)
+        return filepaths
+
+    def get_frame_analysis(self, audio_filepath):
+        """
+            Returns the frame analysis of a source file in the corpus. It is
+            computed and saved to 'frames.npz' in the unit directory unless
+            an up to date one is already there.
+
+        """
+        unit_dir = self._get_unit_dir(audio_filepath)
+        make_dirs(unit_dir)
+        frames_filepath = os.path.join(unit_dir, 'frames.npz')
+        analyser = NumpyAnalyser()
+        if os.path.isfile(frames_filepath) and \
+            os.path.getmtime(frames_filepath) >= \
+                os.path.getmtime(audio_filepath):
+            frames = analyser.load_frames(frames_filepath)
+            if frames is not None:
+                return frames
+        log.debug("Computing frame analysis of '%s'" % audio_filepath)
+        return analyser.analyse_frames(audio_filepath, frames_filepath)
+
     def save_marked_audio(self, filename, onset_weights={}, aubio=None, chop=None):
         """
             Looks for a name - which should be in the db and
             marks the current onsets and saves the file to the corpus.
+            The file is named after the source and the onset settings, so 
+            a repeated request returns the file saved before, as long as 
+            the source hasn't changed since.
 
         """
         path = self.get_filepath(filename)
@@ -488,9 +686,17 @@ class FileCorpus:
             if len(onset_weights) > 0:
                 segmenter.set_weights(onset_weights)
 
+        key = hashlib.sha1(repr((os.path.getsize(path), os.path.getmtime(path),
+            sorted(onset_weights.items()), chop, aubio, 
+            self.aubio_length))).hexdigest()
+        audio_name = os.path.join(self.location, switch_ext(
+            os.path.basename(path), '%s_%s.wav' % (suffix, key[:12])))
+        if os.path.isfile(audio_name) and \
+            os.path.getmtime(audio_name) >= os.path.getmtime(path):
+            log.debug("Using the marked audio saved in %s" % audio_name)
+            return audio_name
         
         audio = segmenter.mark_audio(path)
-        audio_name = os.path.join(self.location, wav_timestamp(filename+suffix))
         log.info("Saving marked audio to %s" % audio_name)
         wavwrite(audio, audio_name, 44100)
         return audio_name
@@ -499,13 +705,21 @@ class FileCorpus:
 # FUNCTIONS TO CREATE AND RETURN GAIA DATASETS FOR SIMILARITY SEARCH IN CORPUS
 ###############################################################################      
     
-    def create_gaia_db(self, chop='onsets'):
+    def create_gaia_db(self, chop='onsets', incremental=True, 
+        shard_size=GAIA_SHARD_SIZE):
         """
             Creates Gaia datasets for all units of the given ``chop`` segmentation
             scheme from all the .yaml files produced by the essentia analysis. 
+            If ``incremental`` is True and the unit dataset was built before,
+            only new or modified analysis files are merged into it and the
+            units which no longer exist are removed. The transformations are
+            only rerun if the new units don't fit the existing normalisation.
+            If ``shard_size`` is given the units are written to shards of at
+            most that many units instead, see ``hmosaic.shards``, and only 
+            the shards holding changed units are built again.
           
         """
-        from gaia2 import DataSet, transform
+        from gaia2 import DataSet
         sig_files = filter(lambda f: os.path.isfile(f), \
             [switch_ext(f, '.yaml') for f in self.list_audio_units(chop=chop)])
         log.debug("Found %d units for the given segmentation scheme: %s" 
@@ -532,41 +746,75 @@ class FileCorpus:
         else:
             f_ds = DataSet.mergeFiles(file_dict)
             f_ds.save(os.path.join(self.location, 'file_ds.db'))
-    
-            tf_ds = transform(f_ds, 'fixlength')
-            tf_ds = transform(tf_ds, 'cleaner')
-            try:
-                tf_ds = transform(tf_ds, 'remove', 
-                    self._get_unused_descriptors())
-            except Exception, e:
-                log.error("Remove unused descriptors failed.... who cares??: '%s'" % e)
-
-            try:
-                tf_ds = transform(tf_ds, 'normalize')
-            except Exception, e:
-                log.error("Transform or normalise failed.")
-                log.error("Might be a target with only high level segment? : '%s' " % e)
+            tf_ds = self._transform_gaia_db(f_ds)
             tf_ds.save(os.path.join(self.location, 'file_ds.db'))
         if len(unit_dict) == 0:
             log.debug("No unit analysis found! Cannot create unit dataset")
-        else:
-            u_ds = DataSet.mergeFiles(unit_dict)
-            tu_ds = transform(u_ds, 'fixlength')
-            tu_ds = transform(tu_ds, 'cleaner')
-            try:
-                tu_ds = transform(tu_ds, 'remove', 
-                    self._get_unused_descriptors())
-            except Exception, e:
-                log.error("Remove unused descriptors failed.... who cares??: '%s'" % e)
-
-            try:
-                tu_ds = transform(tu_ds, 'normalize')
-            except Exception, e:
-                log.error("Transform or normalise failed.")
-                log.error("Might be a target with only high level segment? : '%s' " % e)
-            tu_ds.save(os.path.join(self.location, 'unit_ds_%s.db' % chop))
+        elif shard_size:
+            self._write_gaia_unit_shards(chop, unit_dict, shard_size, 
+                incremental)
+        elif not incremental or not self._update_gaia_unit_db(chop, unit_dict):
+            self._build_gaia_unit_db(chop, unit_dict)
     
-    def get_gaia_unit_db(self, chop='onsets'):
+    def create_analysis_store(self, chop='onsets'):
+        """
+            Imports the .yaml analysis of all units of the given ``chop``
+            into a columnar ``AnalysisStore``, which is returned.
+
+        """
+        store = AnalysisStore(self._get_store_location(chop), self.location)
+        no_units = store.import_yaml(self.list_audio_units(chop=chop))
+        log.debug("Imported the analysis of %d units into '%s'"
+            % (no_units, store.location))
+        return store
+
+    def get_analysis_store(self, chop='onsets'):
+        """
+            Returns the ``AnalysisStore`` holding the analysis of all units
+            of the given ``chop``, creating it first if it doesn't exist or
+            units have been added, removed or analysed again since.
+
+        """
+        store = AnalysisStore(self._get_store_location(chop), self.location)
+        if not store.is_current(self.list_audio_units(chop=chop)):
+            store = self.create_analysis_store(chop=chop)
+        return store
+
+    def create_feature_matrix(self, chop='onsets'):
+        """
+            Exports the .yaml analysis of all units of the given ``chop``
+            as a ``FeatureMatrix``, which is returned. Its rows follow the
+            order of ``list_audio_units``.
+
+        """
+        matrix = FeatureMatrix(self._get_matrix_location(chop), self.location)
+        no_units = matrix.import_yaml(self.list_audio_units(chop=chop))
+        log.debug("Exported the analysis of %d units to '%s'"
+            % (no_units, matrix.location))
+        return matrix
+
+    def get_feature_matrix(self, chop='onsets'):
+        """
+            Returns the ``FeatureMatrix`` of the given ``chop``, exporting
+            it first if it doesn't exist, its rows no longer match the 
+            units of the chop or units have been analysed again since. Use
+            its ``load`` method to memory map it.
+
+        """
+        matrix = FeatureMatrix(self._get_matrix_location(chop), self.location)
+        if not matrix.is_current(self.list_audio_units(chop=chop)):
+            matrix = self.create_feature_matrix(chop=chop)
+        return matrix
+
+    def get_manifest(self, job):
+        """
+            Returns the ``JobManifest`` which records the progress of the 
+            batch ``job`` (e.g. 'analyse_500') on this corpus.
+
+        """
+        return JobManifest(os.path.join(self.location, '%s.journal' % job))
+
+    def get_gaia_unit_db(self, chop='onsets', shard_size=GAIA_SHARD_SIZE):
         """
             Returns a gaia db instance for similarity searching.
             Gaia databases are composed of all units from a given chop size,
@@ -574,21 +822,51 @@ class FileCorpus:
             variable.
             The ``chop`` argument is therefore required as it will be present
             in the filename of the Gaia DataSet on disk.
+            If ``shard_size`` is given the units are kept in shards of that
+            many units, built by ``create_gaia_db`` if they are missing, and
+            a ``ShardedDataSet`` is returned if there is more than one, to be
+            searched with ``get_view``.
+            Loaded datasets are kept in the process wide ``gaia_cache`` until
+            the file changes, so they are only read from disk once and must
+            not be modified.
             
         """
         
-        db_location = os.path.join(self.location, 'unit_ds_%s.db' % chop)
-        if not os.path.isfile(db_location):
-            self.create_gaia_db(chop=chop)
-        if not os.path.isfile(db_location):
+        (db_location, raw_location, manifest_location, history_location) = \
+            self._get_gaia_unit_locations(chop)
+        if shard_size:
+            from hmosaic.shards import get_shards_location, has_shards
+            from hmosaic.shards import load_shards
+            location = get_shards_location(db_location)
+            if not has_shards(db_location, shard_size, history_location):
+                self.create_gaia_db(chop=chop, shard_size=shard_size)
+        else:
+            location = db_location
+            if not os.path.isfile(db_location):
+                self.create_gaia_db(chop=chop, shard_size=None)
+        if not os.path.isfile(location):
             raise FileNotFoundException("This chop cannot be found '%s'" \
                 % (chop)
             )
-        from gaia2 import DataSet
-        unit_db = DataSet()
-        unit_db.load(db_location)
+        key = ('dataset', location)
+        mtime = os.path.getmtime(location)
+        unit_db = gaia_cache.get(key, mtime)
+        if unit_db is not None:
+            log.debug("Using the cached gaia dataset for chop '%s'" % chop)
+            return unit_db
+        if shard_size:
+            unit_db = load_shards(db_location, history_location)
+            size = sum(os.path.getsize(f) for f in unit_db.filepaths)
+            if len(unit_db.filepaths) == 1:
+                location = unit_db.filepaths[0]
+                unit_db = None
+        if unit_db is None:
+            from gaia2 import DataSet
+            unit_db = DataSet()
+            unit_db.load(location)
+            size = os.path.getsize(location)
         
-        return unit_db 
+        return gaia_cache.put(key, unit_db, size, mtime)
         
 ###############################################################################
 # PRIVATE HELPER FUNCTIONS
@@ -603,23 +881,48 @@ class FileCorpus:
         """
         return to_mono(wavread(audio_filepath)[0])
      
+    def _get_unit_dir(self, audio_filepath):
+        """
+            Private function returning the directory which holds the units
+            of ``audio_filepath``.
+
+        """
+        return os.path.join(self.location, \
+            switch_ext(os.path.basename(audio_filepath), ''))
+
+    def _get_segmenter(self, chop, hop=None, onset_weights={}, aubio=False):
+        """
+            Private function returning the segmenter for the given ``chop``.
+
+        """
+        if chop == 'onsets' and STREAMING_ONSETS and not aubio:
+            segmenter = StreamingOnsetSegmenter()
+            if len(onset_weights) > 0:
+                segmenter.set_weights(onset_weights)
+        elif chop == 'onsets':
+            segmenter = NoteOnsetSegmenter(aubio=aubio)
+            segmenter.aubio_length = self.aubio_length
+            if len(onset_weights) > 0:
+                segmenter.set_weights(onset_weights)
+        else:
+            segmenter = AudioSegmenter(chop=chop, hop=hop)
+        return segmenter
+
     def _make_segments_dir(self, audio_filepath, chop):
         """
             Private function to handle creating segment or ``chop``
             subdirectories in the corpus. 
             
         """
-        unit_dir = os.path.join(self.location, \
-            switch_ext(os.path.basename(audio_filepath), ''))
-        if not os.path.isdir(unit_dir):
-            log.debug("Creating unit directory: %s" % unit_dir)
-            os.mkdir(unit_dir)
+        unit_dir = self._get_unit_dir(audio_filepath)
         segments_dir = os.path.join(unit_dir, str(chop))
         if os.path.isdir(segments_dir):
             log.debug("Removing segment directory: '%s'" % segments_dir)
             shutil.rmtree(segments_dir)
         log.debug("Creating segment directory: %s" % segments_dir)
-        os.mkdir(segments_dir)
+        # Other processes may be creating the unit directory, or segmenting
+        # the same file with another chop.
+        make_dirs(segments_dir)
         return segments_dir
     
     def _check_segment_exists(self, name):
@@ -633,13 +936,361 @@ class FileCorpus:
                 % (name)
             )
      
+    def _get_chop_units(self, chop_dir):
+        """
+            Private function listing the units of ``chop_dir`` from the unit
+            index, indexing the directory first if it has changed since it
+            was last indexed.
+
+        """
+        index = self._load_unit_index(os.path.dirname(chop_dir))
+        entry = index['chops'].get(os.path.basename(chop_dir))
+        if entry is None or entry['mtime'] != os.path.getmtime(chop_dir):
+            entry = self._index_chop(chop_dir)
+        return self._entry_units(chop_dir, entry)
+
+    def _entry_units(self, chop_dir, entry):
+        """
+            Private function returning the unit filepaths of a unit index
+            entry. Units numbered from 0 like those written by 
+            ``segment_audio`` are only stored as a count.
+
+        """
+        if 'count' in entry:
+            return [os.path.join(chop_dir, '%07d.wav' % i) 
+                for i in range(entry['count'])]
+        return [os.path.join(chop_dir, name) for name in entry['names']]
+
+    def _index_chop(self, chop_dir, units=None, count=None):
+        """
+            Private function recording the units of ``chop_dir`` in the unit
+            index, either ``count`` units numbered from 0 or the list of 
+            ``units``. The directory is scanned if neither is given.
+            Returns the new index entry.
+
+        """
+        entry = {'mtime': os.path.getmtime(chop_dir)}
+        if count is None:
+            if units is None:
+                units = self._list_units(chop_dir)
+            names = [os.path.relpath(unit, chop_dir) for unit in units]
+            if names == ['%07d.wav' % i for i in range(len(names))]:
+                count = len(names)
+            else:
+                entry['names'] = names
+        if count is not None:
+            entry['count'] = count
+        unit_dir = os.path.dirname(chop_dir)
+        index = self._load_unit_index(unit_dir)
+        index['chops'][os.path.basename(chop_dir)] = entry
+        self._save_unit_index(unit_dir, index)
+        return entry
+
+    def _load_unit_index(self, unit_dir):
+        """
+            Private function returning the unit index of ``unit_dir``, an
+            empty one if there is none yet.
+
+        """
+        index_filepath = os.path.join(unit_dir, 'unit_index.json')
+        try:
+            mtime = os.path.getmtime(index_filepath)
+        except OSError:
+            mtime = None
+        cached = self._unit_indexes.get(unit_dir)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        index = {'version': 1, 'chops': {}}
+        if mtime is not None:
+            f = open(index_filepath)
+            try:
+                index = json.load(f)
+            except ValueError:
+                log.warn("Ignoring the corrupt unit index '%s'" 
+                    % index_filepath)
+            finally:
+                f.close()
+        self._unit_indexes[unit_dir] = (mtime, index)
+        return index
+
+    def _save_unit_index(self, unit_dir, index):
+        """
+            Private function writing the unit index of ``unit_dir``. It is
+            written to a temporary file first and renamed, so other 
+            processes never read a partial index.
+
+        """
+        index_filepath = os.path.join(unit_dir, 'unit_index.json')
+        atomic_write(index_filepath, lambda f: json.dump(index, f), 'w')
+        self._unit_indexes[unit_dir] = (os.path.getmtime(index_filepath), 
+            index)
+
+    def _remove_unit_index(self, unit_dir):
+        """ Private function removing the unit index of ``unit_dir``. """
+
+        self._unit_indexes.pop(unit_dir, None)
+        index_filepath = os.path.join(unit_dir, 'unit_index.json')
+        if os.path.isfile(index_filepath):
+            os.remove(index_filepath)
+
+    def _list_units(self, directory):
+        """
+            Private function listing the units in ``directory`` and its
+            subdirectories, both wav files and virtual units.
+
+        """
+        if get_unit_index(directory) is not None:
+            return list_virtual_units(directory)
+        filepaths = get_files_recursive(directory)
+        for unit_dir in get_directories(directory):
+            if get_unit_index(unit_dir) is not None:
+                filepaths.extend(self._list_units(unit_dir))
+        filepaths.sort()
+        return filepaths
+
     def _list_segments(self):
         """
             Private function to list all the segmented audio folders.
             
         """
-        return get_directories(self.location)
+        return filter(lambda d: not d.endswith('.store'), 
+            get_directories(self.location))
+
+    def _get_store_location(self, chop):
+        """
+            Private function returning the location of the analysis store
+            for the given ``chop``.
+
+        """
+        return os.path.join(self.location, 'units_%s.store' % chop)
+
+    def _get_gaia_unit_locations(self, chop):
+        """
+            Private function returning the locations of the unit dataset of
+            ``chop``, of the merged dataset it was transformed from, of the
+            manifest of analysis files merged into them and of its 
+            transformation history.
+
+        """
+        db_location = os.path.join(self.location, 'unit_ds_%s.db' % chop)
+        return (db_location, switch_ext(db_location, '.raw.db'),
+            switch_ext(db_location, '.json'), 
+            switch_ext(db_location, '.history'))
+
+    def _build_gaia_unit_db(self, chop, unit_dict):
+        """
+            Private function building the unit dataset of ``chop`` from all
+            the analysis files in ``unit_dict``.
+
+        """
+        from gaia2 import DataSet
+        (db_location, raw_location, manifest_location, history_location) = \
+            self._get_gaia_unit_locations(chop)
+        mtimes = dict((sig, os.path.getmtime(sig)) for sig in unit_dict)
+        if os.path.isfile(manifest_location):
+            os.remove(manifest_location)
+        u_ds = DataSet.mergeFiles(unit_dict)
+        u_ds.save(raw_location)
+        tu_ds = self._transform_gaia_db(u_ds)
+        tu_ds.history().save(history_location)
+        tu_ds.save(db_location)
+        self._save_gaia_manifest(manifest_location, mtimes)
+
+    def _write_gaia_unit_shards(self, chop, unit_dict, shard_size, 
+        incremental=True):
+        """
+            Private function writing the analysis files in ``unit_dict`` to
+            the shards of the unit dataset of ``chop``. Unless 
+            ``incremental`` is True and there is a transformation history 
+            already, the transformations are learned from a sample of the
+            units first, so that no dataset of all of them is ever built, 
+            and every shard is built again. Otherwise only the shards 
+            holding new, modified or removed units are, mapped through the
+            existing history. The shard index records the units of each
+            shard, so the manifest of the unit dataset isn't used.
+
+        """
+        from hmosaic.shards import write_shards
+        (db_location, raw_location, manifest_location, history_location) = \
+            self._get_gaia_unit_locations(chop)
+        mtimes = dict((sig, os.path.getmtime(sig)) for sig in unit_dict)
+        if not incremental or not os.path.isfile(history_location):
+            self._fit_gaia_history(sorted(mtimes), shard_size).save(
+                history_location)
+        write_shards(db_location, shard_size, mtimes, history_location)
+
+    def _fit_gaia_history(self, sigs, sample_size):
+        """
+            Private function learning the standard transformations from at
+            most ``sample_size`` of the analysis files ``sigs``, spread 
+            evenly over them. Returns the transformation history. Units 
+            outside the sample may fall a little outside the normalised 
+            range, which doesn't stop them being searched.
+
+        """
+        from gaia2 import DataSet
+        step = max(1, -(-len(sigs) // sample_size))
+        sample = sigs[::step]
+        log.debug("Learning the transformations from %d of %d units"
+            % (len(sample), len(sigs)))
+        u_ds = DataSet.mergeFiles(dict((sig, sig) for sig in sample))
+        return self._transform_gaia_db(u_ds).history()
+
+    def _update_gaia_unit_db(self, chop, unit_dict):
+        """
+            Private function merging the analysis files in ``unit_dict``
+            which are new or modified into the existing unit dataset of
+            ``chop`` and removing the units which are gone. The new units
+            are mapped through the transformation history of the dataset,
+            unless that would change the normalisation, in which case the
+            merged dataset is transformed again. Returns False if there is
+            no complete dataset to update.
+
+        """
+        from gaia2 import DataSet, Point
+        (db_location, raw_location, manifest_location, history_location) = \
+            self._get_gaia_unit_locations(chop)
+        manifest = self._load_gaia_manifest(manifest_location)
+        if manifest is None or not os.path.isfile(raw_location) or \
+            not os.path.isfile(db_location) or \
+                not os.path.isfile(history_location):
+            return False
+        mtimes = dict((sig, os.path.getmtime(sig)) for sig in unit_dict)
+        removed = [sig for sig in manifest if mtimes.get(sig) != manifest[sig]]
+        merged = [sig for sig in mtimes if manifest.get(sig) != mtimes[sig]]
+        if len(removed) == 0 and len(merged) == 0:
+            log.debug("The unit dataset for chop '%s' is up to date" % chop)
+            return True
+        log.debug("Updating the unit dataset for chop '%s': %d units to "
+            "remove, %d to merge" % (chop, len(removed), len(merged)))
+        points = []
+        for sig in merged:
+            p = Point()
+            p.load(sig)
+            p.setName(sig)
+            points.append(p)
+        u_ds = DataSet()
+        u_ds.load(raw_location)
+        try:
+            for sig in removed:
+                u_ds.removePoint(sig)
+            for p in points:
+                u_ds.addPoint(p)
+        except Exception, e:
+            log.error("Merging into the unit dataset failed, rebuilding it: "
+                "'%s'" % e)
+            return False
+        tu_ds = DataSet()
+        tu_ds.load(db_location)
+        if not self._map_gaia_points(tu_ds, removed, points):
+            log.debug("Descriptor ranges have changed, normalising again")
+            tu_ds = self._transform_gaia_db(u_ds)
+        os.remove(manifest_location)
+        u_ds.save(raw_location)
+        tu_ds.history().save(history_location)
+        tu_ds.save(db_location)
+        self._save_gaia_manifest(manifest_location, mtimes)
+        return True
+
+    def _map_gaia_points(self, tu_ds, removed, points):
+        """
+            Private function removing the ``removed`` units from the 
+            transformed dataset ``tu_ds`` and adding ``points`` mapped 
+            through its history. Returns False if the normalisation of 
+            ``tu_ds`` doesn't hold any more: a removed unit was at the 
+            limit of a descriptor's range or a new one falls outside it.
+
+        """
+        from gaia2 import RealType
+        try:
+            names = tu_ds.layout().descriptorNames(RealType)
+            for sig in removed:
+                (low, high) = self._get_gaia_range(tu_ds.point(sig), names)
+                if low <= GAIA_RANGE_TOLERANCE or \
+                    high >= 1 - GAIA_RANGE_TOLERANCE:
+                    return False
+                tu_ds.removePoint(sig)
+            history = tu_ds.history()
+            for p in points:
+                mapped = history.mapPoint(p)
+                mapped.setName(p.name())
+                (low, high) = self._get_gaia_range(mapped, names)
+                if low < -GAIA_RANGE_TOLERANCE or \
+                    high > 1 + GAIA_RANGE_TOLERANCE:
+                    return False
+                tu_ds.addPoint(mapped)
+        except Exception, e:
+            log.debug("Cannot map the units into the dataset: '%s'" % e)
+            return False
+        return True
+
+    def _get_gaia_range(self, point, names):
+        """
+            Private function returning the lowest and highest value of the
+            real descriptors ``names`` of the gaia ``point``.
+
+        """
+        values = np.concatenate([np.ravel(np.asarray(point.value(name), 
+            dtype=float)) for name in names])
+        return (values.min(), values.max())
+
+    def _transform_gaia_db(self, ds):
+        """
+            Private function applying the standard transformations to a
+            merged gaia dataset ``ds``, returning the transformed dataset.
+
+        """
+        from gaia2 import transform
+        t_ds = transform(ds, 'fixlength')
+        t_ds = transform(t_ds, 'cleaner')
+        try:
+            t_ds = transform(t_ds, 'remove', 
+                self._get_unused_descriptors())
+        except Exception, e:
+            log.error("Remove unused descriptors failed.... who cares??: '%s'" % e)
+
+        try:
+            t_ds = transform(t_ds, 'normalize')
+        except Exception, e:
+            log.error("Transform or normalise failed.")
+            log.error("Might be a target with only high level segment? : '%s' " % e)
+        return t_ds
+
+    def _load_gaia_manifest(self, manifest_location):
+        """
+            Private function returning the modification time of each of the 
+            analysis files in a unit dataset, None if it isn't known.
+
+        """
+        if not os.path.isfile(manifest_location):
+            return None
+        f = open(manifest_location)
+        try:
+            return json.load(f)['units']
+        except (ValueError, KeyError):
+            log.warn("Ignoring the corrupt dataset manifest '%s'" 
+                % manifest_location)
+            return None
+        finally:
+            f.close()
+
+    def _save_gaia_manifest(self, manifest_location, mtimes):
+        """
+            Private function writing the manifest of a unit dataset, via a
+            temporary file so that it only exists once it is complete.
+
+        """
+        atomic_write(manifest_location, lambda f: json.dump({'version': 1, 
+            'units': mtimes}, f), 'w')
         
+    def _get_matrix_location(self, chop):
+        """
+            Private function returning the location of the feature matrix
+            for the given ``chop``, without the extension.
+
+        """
+        return os.path.join(self.location, 'features_%s' % chop)
+
     def _check_exists(self, filename):
         """
             Utility function which raises an exception if the file cannot
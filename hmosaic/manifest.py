@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Durable job manifests for long running batch jobs like corpus analysis.
+A manifest is a journal file with one line per event, recording when a file
+was queued (pending), and when it was finished (done or failed) along with
+how long it took. Lines are only ever appended, so an interrupted job loses
+at most the file it was working on, and rerunning the job with the manifest
+skips everything which was already finished. Named steps of a job which
+aren't files, like preparing a corpus, are recorded in the same journal.
+
+"""
+
+# Standard library imports
+import os
+import time
+import json
+
+# hmosaic package imports
+from hmosaic import log
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobManifest(object):
+    """
+        The manifest of a batch job, stored at ``location``.
+        A finished file is only skipped on resume while it is unmodified,
+        so re-segmenting audio invalidates the analysis of its units. 
+        Steps are kept apart from the files, by name, and stay finished.
+
+    """
+
+    def __init__(self, location):
+        """
+            Replays the journal at ``location``, if there is one.
+
+        """
+        self.location = os.path.abspath(location)
+        self.jobs = {}
+        self.steps = {}
+        self._load()
+
+    def reset(self):
+        """ Forgets all jobs and steps and removes the journal. """
+
+        self.jobs = {}
+        self.steps = {}
+        self._torn = False
+        if os.path.isfile(self.location):
+            os.remove(self.location)
+
+    def add(self, filepaths):
+        """
+            Queues each of ``filepaths`` which isn't already known to the
+            manifest.
+
+        """
+        events = []
+        for filepath in filepaths:
+            if filepath not in self.jobs:
+                events.append(self._event(filepath, PENDING))
+        self._write(events)
+
+    def get_pending(self, filepaths, retry_failed=False):
+        """
+            Returns those of ``filepaths`` which still need to be processed:
+            everything not finished, or modified since it was finished.
+            Failed files are only returned if ``retry_failed`` is True.
+
+        """
+        pending = []
+        for filepath in filepaths:
+            job = self.jobs.get(filepath)
+            if job is None or job['state'] == PENDING or \
+                (job['state'] == FAILED and retry_failed) or \
+                    job['mtime'] != _get_mtime(filepath):
+                pending.append(filepath)
+        return pending
+
+    def record(self, filepath, state, elapsed=None, error=None):
+        """
+            Records that the job for ``filepath`` has reached ``state``,
+            taking ``elapsed`` seconds.
+
+        """
+        self._write([self._event(filepath, state, elapsed, error)])
+
+    def record_step(self, step):
+        """ Records that the named ``step`` has finished. """
+
+        self._write([{'step': step, 'state': DONE, 'time': time.time()}])
+
+    def is_done(self, step):
+        """ Returns True if the named ``step`` has finished. """
+
+        return step in self.steps
+
+    def record_result(self, result):
+        """ Records an ``AnalysisResult`` from an analyser. """
+
+        if result.error:
+            self.record(result.filepath, FAILED, result.elapsed,
+                str(result.error))
+        else:
+            self.record(result.filepath, DONE, result.elapsed)
+
+    def report(self, top=10):
+        """
+            Summarises the job. Returns a dictionary with:
+             *  the number of ``pending``, ``done`` and ``failed`` files
+             *  ``analysis_time`` - the sum of the time spent on each file
+             *  ``wall_time`` - from the first to the last finished file
+             *  ``throughput`` - files finished per second of wall time
+             *  ``slowest`` - the ``top`` slowest files as (seconds, path)
+             *  ``failures_by_dir`` and ``failures_by_error`` - the ``top``
+                directories and error messages with most failures, as
+                (count, name)
+
+        """
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        finished = []
+        dir_failures = {}
+        error_failures = {}
+        for filepath, job in self.jobs.items():
+            counts[job['state']] += 1
+            if job['state'] == PENDING:
+                continue
+            finished.append(job)
+            if job['state'] == FAILED:
+                directory = os.path.dirname(filepath)
+                dir_failures[directory] = dir_failures.get(directory, 0) + 1
+                error = (job['error'] or '').split('\n')[0][:200]
+                error_failures[error] = error_failures.get(error, 0) + 1
+        analysis_time = sum(job['elapsed'] or 0.0 for job in finished)
+        if len(finished) > 1:
+            wall_time = max(job['time'] for job in finished) - \
+                min(job['time'] - (job['elapsed'] or 0.0) for job in finished)
+        else:
+            wall_time = analysis_time
+        if wall_time > 0:
+            throughput = len(finished) / wall_time
+        else:
+            throughput = 0.0
+        slowest = sorted(((job['elapsed'] or 0.0, filepath) for filepath,
+            job in self.jobs.items() if job['state'] != PENDING),
+            reverse=True)[:top]
+        by_count = lambda failures: sorted(((count, name) for name, count
+            in failures.items()), reverse=True)[:top]
+        return {
+            'pending': counts[PENDING],
+            'done': counts[DONE],
+            'failed': counts[FAILED],
+            'analysis_time': analysis_time,
+            'wall_time': wall_time,
+            'throughput': throughput,
+            'slowest': slowest,
+            'failures_by_dir': by_count(dir_failures),
+            'failures_by_error': by_count(error_failures)
+        }
+
+    def _event(self, filepath, state, elapsed=None, error=None):
+        return {'path': filepath, 'state': state, 'time': time.time(),
+            'elapsed': elapsed, 'error': error,
+            'mtime': _get_mtime(filepath)}
+
+    def _apply(self, event):
+        if 'step' in event:
+            self.steps[event['step']] = event
+        else:
+            self.jobs[event['path']] = event
+
+    def _load(self):
+        """
+            Replays the journal. A line torn by a crash is ignored, and
+            terminated so that the next event starts on a line of its own.
+
+        """
+        self._torn = False
+        if not os.path.isfile(self.location):
+            return
+        f = open(self.location)
+        try:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    log.warn("Ignoring a corrupt line in manifest '%s'"
+                        % self.location)
+                self._torn = not line.endswith('\n')
+        finally:
+            f.close()
+
+    def _write(self, events):
+        """
+            Appends ``events`` to the journal, flushing before returning.
+
+        """
+        if len(events) == 0:
+            return
+        f = open(self.location, 'a')
+        try:
+            if self._torn:
+                f.write('\n')
+                self._torn = False
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+                self._apply(event)
+            f.flush()
+        finally:
+            f.close()
+
+
+def _get_mtime(filepath):
+    """ Returns the modification time of ``filepath``, None if missing. """
+
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return None
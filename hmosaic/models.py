@@ -18,7 +18,8 @@ from storm.locals import Date, Bool, Reference, Unicode, Int, Float
 
 # Project imports
 from hmosaic import log
-from hmosaic.utils import secs_to_samps, timestretch
+from hmosaic.utils import secs_to_samps, timestretch, read_wav_memmap
+from hmosaic.utils import read_unit
 
 class DBSong(object):
     """
@@ -59,9 +60,12 @@ class SegmentAudio():
         Very simple audio class - encapsulates the following information
         about an audio file
          *  ``filepath`` - location of original file.
-         *  ``audio_array`` - 32bit floating point array of audio signal.
+         *  ``audio_array`` - array of audio signal, memory mapped from the
+            file in its own encoding (e.g. 16bit integers), so slices of it
+            are views which read only their own samples from disk. 
+            Use ``hmosaic.utils.to_float`` where floating point is needed.
          *  ``sample_rate`` - Sampling rate of the audio.
-         *  ``format`` - format of the wav file.
+         *  ``format`` - encoding of the wav file, e.g. 'pcm16'.
          *  ``name`` - basename from the filepath
          *  ``samples`` - number of samples in the array
          *  ``length`` - Length of the audio in seconds. 
@@ -73,7 +77,8 @@ class SegmentAudio():
     def __init__(self, filepath):
         
         self.filepath = filepath
-        (self.audio_array, self.sample_rate, self.format) = wavread(filepath)
+        (self.audio_array, self.sample_rate, self.format) = \
+            read_wav_memmap(filepath)
         self.name = os.path.basename(filepath)
         samples = len(self.audio_array)
         self.length = float(samples) / float(self.sample_rate)
@@ -87,7 +92,8 @@ class Unit():
         file. All parameters are passed to it in the initialiser.
         
         It stores only the following attributes:
-         *  ``data`` - 32bit floating point array of audio signal.
+         *  ``data`` - array of audio signal, which may be a view into the
+            memory mapped ``audio_array`` of a ``SegmentAudio``.
          *  ``sample_rate`` - Sampling rate of the audio.
          *  ``length`` - Length of the audio in seconds. 
             
@@ -347,7 +353,8 @@ class MosaicUnit(object):
     """
         Another bare bones audio class - practially identical to SegmentAudio,
         except that it can be marked as silent, and it can also recalculate 
-        its own properties.
+        its own properties. The unit may be a wav file or a virtual unit, 
+        whose audio is read from its source file.
         
     """
     def __init__(self, filepath):
@@ -356,7 +363,7 @@ class MosaicUnit(object):
             
         """
         self.filepath = filepath
-        (self.data, self.sample_rate, self.format) = wavread(filepath)
+        (self.data, self.sample_rate, self.format) = read_unit(filepath)
         self.name = os.path.basename(filepath)
         samples = len(self.data)
         self.length = float(samples) / float(self.sample_rate)
@@ -377,7 +384,7 @@ class MosaicUnit(object):
             is read and the current data is replaced by this new data.
         """
         self.filepath = path
-        (self.data, self.sample_rate, self.format) = wavread(path)
+        (self.data, self.sample_rate, self.format) = read_unit(path)
         self.recalculate()
         
         
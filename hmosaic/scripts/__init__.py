@@ -1,44 +1,168 @@
-from hmosaic.analyse import EssentiaAnalyser, EssentiaError
-from hmosaic import log
+import time
+from multiprocessing import Pool, cpu_count
 
-def segment_corpus(corpus):
+from hmosaic.analyse import EssentiaAnalyser, EssentiaError, get_unit_analyser
+from hmosaic.manifest import DONE, FAILED
+from hmosaic.segment import DetectionFunctionCache
+from hmosaic.utils import calc_chop_from_bpm
+from hmosaic import log, settings
+
+def segment_corpus(corpus, chop='onsets', hop=None, onset_weights={}, 
+    workers=None, manifest=None):
     """
         Reusable script function for segmenting a corpus.
+        Every audio file of the corpus is segmented, see ``segment_files``.
         
     """
-    weights = {'rms': 0.8, 'hfc': 0.3, 'complex': 0.2}
-    print corpus.list_audio_files()
-    for audio_file in corpus.list_audio_files():
-        corpus.segment_audio(audio_file, 'onsets')
-        #corpus.segment_audio(audio_file, 4000)
-        #corpus.segment_audio(audio_file, 1250)
-        #corpus.segment_audio(audio_file, 'onsets', weights)     
+    return segment_files(corpus, corpus.list_audio_files(), chop, hop, 
+        onset_weights, workers, manifest)
+
+def segment_files(corpus, audio_files, chop='onsets', hop=None, 
+    onset_weights={}, workers=None, manifest=None):
+    """
+        Segments each of ``audio_files`` in the corpus, ``workers`` files
+        at a time in separate processes. ``chop`` may be a list of chops, 
+        as for ``FileCorpus.segment_audio``. ``workers`` defaults to 
+        ``settings.SEGMENTATION_WORKERS``, or one per cpu if that is None.
+        Each file is logged as it finishes and recorded in the 
+        ``manifest``, if one is given. A file which fails is logged and 
+        skipped. The onset cache is pruned afterwards, if enabled. Returns
+        the list of files which failed.
+
+    """
+    if workers is None:
+        workers = settings.SEGMENTATION_WORKERS or cpu_count()
+    tasks = [(corpus, audio_file, chop, hop, onset_weights) 
+        for audio_file in audio_files]
+    workers = max(min(workers, len(tasks)), 1)
+    if workers == 1:
+        results = (_segment_file(task) for task in tasks)
+        pool = None
+    else:
+        pool = Pool(workers)
+        results = pool.imap_unordered(_segment_file, tasks)
+    failed = []
+    try:
+        for done, (audio_file, elapsed, error) in enumerate(results):
+            if error:
+                log.error("Segmentation of '%s' failed, skipping it: %s" 
+                    % (audio_file, error))
+                failed.append(audio_file)
+            else:
+                log.info("Segmented %d of %d files in %.1f s: '%s'" 
+                    % (done + 1, len(tasks), elapsed, audio_file))
+            if manifest is not None:
+                manifest.record(audio_file, FAILED if error else DONE, 
+                    elapsed, error)
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    if settings.ONSET_CACHE_DIR:
+        DetectionFunctionCache(settings.ONSET_CACHE_DIR).prune()
+    return failed
         
 
-def analyse_corpus(corpus, chop=None):
+def aggregate_corpus(corpus, chop=500, hop=None, bpm=None):
+    """
+        Reusable script function for analysing every unit of a corpus for 
+        a given ``chop`` from the frame analysis of each source file.
+        If ``bpm`` is given the chop is derived from it instead, and 
+        returned.
+        
+    """
+    if bpm is not None:
+        chop = calc_chop_from_bpm(bpm)
+    for audio_file in corpus.list_audio_files():
+        corpus.aggregate_units(audio_file, chop, hop)
+    return chop
+
+def analyse_corpus(corpus, chop=None, workers=None, resume=False):
     """
         Reusable script function for analysing a corpus.
+        Units are analysed ``workers`` at a time, using the
+        analyser configured in ``settings.UNIT_ANALYSER``.
+        Progress is recorded in the corpus manifest for the ``chop``, if
+        ``resume`` is True the units finished by a previous run are skipped.
         
     """
     file_list = corpus.list_audio_units(chop=chop)
-    analyser = EssentiaAnalyser()
-    for audio_file in file_list:
-        try:
-            analyser.analyse_audio(audio_file)
-        except EssentiaError, e:
-            log.error("Essentia threw an error (%s), skipping this one: '%s'" 
-                % (e, audio_file))
+    manifest = corpus.get_manifest('analyse_%s' % chop)
+    _run_analysis(get_unit_analyser(), file_list, manifest, workers, resume)
 
-def analyse_corpus_files(corpus):
+def analyse_corpus_files(corpus, workers=None, resume=False):
     """
         Reusable script function for analysing the audio files comprising a corpus.
+        Files are analysed ``workers`` at a time, and may be resumed like 
+        ``analyse_corpus``.
         
     """
     file_list = corpus.list_audio_files()
-    analyser = EssentiaAnalyser()
-    for audio_file in file_list:
-        try:
-            analyser.analyse_audio(audio_file)
-        except EssentiaError, e:
+    manifest = corpus.get_manifest('analyse_files')
+    _run_analysis(EssentiaAnalyser(), file_list, manifest, workers, resume)
+
+def report_analysis(corpus, chop=None):
+    """
+        Logs a report of the throughput and failures of the analysis of the
+        units of ``chop``, or of the files of the corpus if it is None.
+        The report is returned too.
+
+    """
+    if chop is None:
+        manifest = corpus.get_manifest('analyse_files')
+    else:
+        manifest = corpus.get_manifest('analyse_%s' % chop)
+    report = manifest.report()
+    log.info("%d done, %d failed, %d pending in %s" % (report['done'], 
+        report['failed'], report['pending'], manifest.location))
+    log.info("%.1f files per second, %.1f s analysing in %.1f s" % (
+        report['throughput'], report['analysis_time'], report['wall_time']))
+    for elapsed, filepath in report['slowest']:
+        log.info("Slow: %.3f s '%s'" % (elapsed, filepath))
+    for count, directory in report['failures_by_dir']:
+        log.info("%d failures in '%s'" % (count, directory))
+    for count, error in report['failures_by_error']:
+        log.info("%d failures with '%s'" % (count, error))
+    return report
+
+def _segment_file(task):
+    """
+        Segments one file in a worker process. Returns the file, the time
+        taken and the error if it failed, which is sent back as a string
+        so that it can always be pickled.
+
+    """
+    (corpus, audio_file, chop, hop, onset_weights) = task
+    start = time.time()
+    try:
+        corpus.segment_audio(audio_file, chop, hop, onset_weights)
+    except Exception, e:
+        return audio_file, time.time() - start, '%s: %s' % (
+            e.__class__.__name__, e)
+    return audio_file, time.time() - start, None
+
+def _run_analysis(analyser, file_list, manifest, workers, resume):
+    """
+        Analyses the files in ``file_list`` which are pending in the 
+        ``manifest``, recording each result as it arrives. The analysis
+        cache is pruned afterwards, if the analyser has one.
+
+    """
+    if resume:
+        file_list = manifest.get_pending(file_list)
+        log.info("Resuming analysis, %d files left" % len(file_list))
+    else:
+        manifest.reset()
+    manifest.add(file_list)
+    for result in analyser.analyse_batch(file_list, workers):
+        manifest.record_result(result)
+        if result.error:
             log.error("Essentia threw an error (%s), skipping this one: '%s'" 
-                % (e, audio_file))
+                % (result.error, result.filepath))
+    if getattr(analyser, 'cache', None):
+        analyser.cache.prune()
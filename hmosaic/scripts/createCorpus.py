@@ -10,17 +10,55 @@ import simplejson as json
 
 
 # Project imports
-from hmosaic.scripts import analyse_corpus, analyse_corpus_files
+from hmosaic.scripts import analyse_corpus, analyse_corpus_files, segment_files
 from hmosaic.scripts import convertAudio as ca
-from hmosaic.corpus import FileCorpusManager, CorpusExistsException
+from hmosaic.corpus import FileCorpusManager, FileCorpus, CorpusExistsException
+from hmosaic import log
 
 
-def create_corpus(filepath, weights, chop):
+def create_corpus(filepath, weights, chop, resume=False):
     """
         Create a directory callled corpus in the same directory as filepath,
         convert all the audio files, segment and analyse...
         ffmpeg must be installed for Mp3 conversion to work 
+        Progress is recorded in manifests in the corpus. If ``resume`` is 
+        True an interrupted run is continued, otherwise any existing corpus
+        is replaced.
     
+    """
+    if os.path.isfile(filepath):
+        repository = os.path.dirname(filepath)
+    else:
+        repository = filepath
+    corpus_path = os.path.join(repository, 'corpus')
+    if resume and os.path.isdir(corpus_path) and \
+        FileCorpus(corpus_path).get_manifest('create').is_done('prepare'):
+        c = FileCorpusManager(repository).load_corpus('corpus')
+        log.info("Resuming the creation of corpus '%s'" % c.location)
+    else:
+        c = _prepare_corpus(filepath)
+
+    segment_manifest = c.get_manifest('segment_%s' % chop)
+    audio_files = c.list_audio_files()
+    if resume:
+        audio_files = segment_manifest.get_pending(audio_files)
+    else:
+        segment_manifest.reset()
+    if chop == 'onsets':
+        # Weights are given in the order of the command line option.
+        onset_weights = dict(zip(['hfc', 'complex', 'rms'], weights))
+        segment_files(c, audio_files, chop, onset_weights=onset_weights, 
+            manifest=segment_manifest)
+
+    analyse_corpus(c, chop, resume=resume)
+    analyse_corpus_files(c, resume=resume)
+
+def _prepare_corpus(filepath):
+    """
+        Creates a fresh corpus from ``filepath`` and converts its audio.
+        This step is recorded in the 'create' manifest of the corpus when
+        it completes.
+
     """
     if os.path.isfile(filepath):
         cm = FileCorpusManager(os.path.dirname(filepath))
@@ -50,14 +88,8 @@ def create_corpus(filepath, weights, chop):
     ca.rename_wavs()
     ca.execute_flac_convert()
     ca.execute_mp3_convert()
-   
-
-    if chop == 'onsets':
-        for audio_file in c.list_audio_files():
-            c.segment_audio(audio_file, chop, weights)
-
-    analyse_corpus(c, chop)
-    analyse_corpus_files(c)
+    c.get_manifest('create').record_step('prepare')
+    return c
 
     
 
@@ -74,6 +106,8 @@ def parseCommandLineOptions():
         help="Set weights for the onset detectors: [hfc, complex, rms]. E.g. -w '[1, 0.3, 0.4]'")
     parser.add_option("-f", "--fixed", 
         help="Use fixed-length segmentation - supply a value in milliseconds e.g. 500, 1000, etc.")
+    parser.add_option("-r", "--resume", action="store_true", default=False,
+        help="Resume an interrupted run, skipping the work already done.")
 
     
 
@@ -105,14 +139,14 @@ def parseCommandLineOptions():
     
     
 
-    return options.target, weights, chop
+    return options.target, weights, chop, options.resume
 
 
 if __name__ == '__main__':
     """ run this file as a script. """
-    filepath, weights, chop = parseCommandLineOptions()
+    filepath, weights, chop, resume = parseCommandLineOptions()
     try:
-        create_corpus(filepath, weights, chop)
+        create_corpus(filepath, weights, chop, resume)
     except Exception, e:
         print("Exception occurred: %s" % e)
         raise
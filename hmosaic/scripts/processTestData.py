@@ -13,10 +13,8 @@ import os, shutil
 from glob import glob
 from random import randint
 
-import yaml
 import numpy as np
 from csv import DictWriter
-from gaia2 import Point
 from scipy import stats
 
 # Project imports
@@ -28,17 +26,19 @@ from hmosaic.scripts import segment_corpus, analyse_corpus, analyse_corpus_files
 from hmosaic.scripts import convertAudio as ca
 from hmosaic.utils import switch_ext, get_db_connection, get_gaia_point
 from hmosaic.models import DBSegment, DBSong
+from hmosaic.store import read_analyses
 from hmosaic.control import HighLevelControl
 
 
 def segment(chop):
     """
-        Segment all audio files in the test corpus according to ``chop``.
+        Segment all audio files in the test corpus according to ``chop``,
+        which may be a list of chops.
         
     """
     cm = FileCorpusManager(settings.TEST_CORPUS_REPO)
     corpus = cm.load_corpus(settings.TEST_CORPUS)
-    segment_corpus(corpus)
+    segment_corpus(corpus, chop)
   
 
 def analyse_essentia_units(chop):
@@ -102,14 +102,8 @@ def run_tasks():
     log.info("Creating and populating the test_corpus")
     create_and_populate()
     
-    log.info("Segmenting into units of 200 ms")
-    segment(200)
-    
-    log.info("Segmenting into units of 500 ms")
-    segment(500)
-    
-    log.info("Segmenting into units of 1250 ms")
-    segment(1250)
+    log.info("Segmenting into units of 200, 500 and 1250 ms")
+    segment([200, 500, 1250])
     
     #log.info("Segmenting into units based on onsets")
     #segment('onsets')
@@ -136,15 +130,15 @@ def display_file_values(*args):
     """
     cm = FileCorpusManager(settings.TEST_CORPUS_REPO)
     corpus = cm.load_corpus(settings.TEST_CORPUS)
-    for f in corpus.list_audio_files():
-        a = yaml.load(open(switch_ext(f, '.yaml'), 'r').read())
+    files = corpus.list_audio_files()
+    analyses = read_analyses([switch_ext(f, '.yaml') for f in files], args)
+    for f, a in zip(files, analyses):
+        if a is None:
+            log.error("Analysis not found for file %s" % f)
+            continue
         for arg in args:
             log.info("For file %s" % f)
-            keys = arg.split('.')
-            newa = a
-            for k in keys:
-                newa = newa[k]
-            log.info("%s is %s" % (arg, newa))
+            log.info("%s is %s" % (arg, a[arg]))
 
 
 def create_db():
@@ -176,8 +170,10 @@ def add_to_db():
 def gather_csv_data(*args):
     """
         This function gets given a corpus and extracts the descriptors 
-        given in the *args* to the function. It records this data, 
-        audio file name and segment duration.
+        given in the *args* to the function. Numeric descriptors are read
+        from the analysis store of each segment duration, others from the
+        .yaml analysis. It records this data, audio file name and segment 
+        duration.
 
     """
     cm = FileCorpusManager(settings.TEST_CORPUS_REPO)
@@ -190,21 +186,37 @@ def gather_csv_data(*args):
     csv = DictWriter(report,fieldnames)
     csv.writerow(dict(zip(fieldnames, fieldnames)))
     
+    # The numeric descriptors are read from the analysis store of each 
+    # chop, along with the row of each unit in it. The store leaves out
+    # the others, e.g. the labels of the high level classifiers, so they
+    # are read from the .yaml analysis of the stored units in parallel.
+    stores = {}
+    for c in [200, 500, 1250]:
+        store = corpus.get_analysis_store(c)
+        units = store.list_units()
+        rows = dict((u, i) for (i, u) in enumerate(units))
+        stored = [arg for arg in args if arg in store.descriptor_names()]
+        others = [arg for arg in args if arg not in stored]
+        values = {}
+        if others:
+            values = dict(zip(units, read_analyses(
+                [switch_ext(u, '.yaml') for u in units], others)))
+        stores[c] = (rows, store.load(stored), values)
     for f in corpus.list_audio_files():
         for c in [200, 500, 1250]:
+            (rows, columns, values) = stores[c]
             for s in corpus.list_audio_units(audio_filename=os.path.basename(f), chop=c):
-                try:
-                    a = yaml.load(open(switch_ext(s, '.yaml'), 'r').read())
-                except IOError, e:
-                    log.error("Analysis not found - must be silent: %s" % e)
+                unit = os.path.abspath(s)
+                row = rows.get(unit)
+                if row is None:
+                    log.error("Analysis not found - must be silent: %s" % s)
                     continue
                 vals = [s, os.path.basename(f), c]
                 for arg in args:
-                    newa = a
-                    keys = arg.split('.')
-                    for k in keys:
-                        newa = newa[k]
-                    vals.append(newa)
+                    if arg in columns:
+                        vals.append(columns[arg][row].tolist())
+                    else:
+                        vals.append(values[unit][arg])
                 csv.writerow(dict(zip(fieldnames,  vals)))
     report.close()
 
@@ -395,10 +407,10 @@ def add_gender(*args):
 
 def map_mosaics(corpus_name, chop, from_scratch=False, hop=False):
     """
-        Returns dictionary containing mood values over time for all
-        audio files in the test corpus. The resolution of the graphs can be 
-        increased using the **hop** parameter
-        (a value between 0 and 1 indicating overlap factor).
+        Returns dictionary containing mood values over time, per unit of
+        the given ``chop``, for all audio files in the test corpus. The 
+        resolution of the graphs can be increased using the **hop** 
+        parameter (a value between 0 and 1 indicating overlap factor).
 
     """
     cm = FileCorpusManager(settings.TEST_CORPUS_REPO)       
@@ -414,17 +426,20 @@ def map_mosaics(corpus_name, chop, from_scratch=False, hop=False):
     
     graphs = {'RELAXED':{}, 'SAD':{}, 'HAPPY':{}, 'AGGRESSIVE':{}}
 
+    # The moods of all units of the chop are read from its feature matrix.
+    matrix = c.get_feature_matrix(chop)
+    (values, names, units) = matrix.load()
+    rows = dict((u, i) for (i, u) in enumerate(units))
+    moods = graphs.keys()
+    columns = [matrix.columns(getattr(settings, k))[0] for k in moods]
     for f in c.list_audio_files():
-        analysis = [switch_ext(u, '.yaml') for u in 
-            c.list_audio_units(audio_filename=f)]
-        points = []
-        for a in analysis:
-            p = Point()
-            p.load(a)
-            points.append(p)
-        for k in graphs.keys():
-            graphs[k].update({os.path.basename(f):
-                [p[getattr(settings, k)] for p in points]})
+        file_rows = [rows[os.path.abspath(u)] for u in 
+            c.list_audio_units(audio_filename=f, chop=chop)]
+        points = values[np.ix_(file_rows, columns)]
+        # Silent units have no analysis, so their row is NaN.
+        points = points[~np.isnan(points).all(axis=1)]
+        for (k, column) in zip(moods, points.T):
+            graphs[k].update({os.path.basename(f): column.tolist()})
 
     return graphs
 
@@ -8,21 +8,27 @@ Aubio and Essentia are both utilised by different routines.
 # Standard library imports
 import os
 import subprocess
+import hashlib
 
 # Third party library imports
-from scikits.audiolab import wavread, wavwrite
+from scikits.audiolab import wavread, wavwrite, Sndfile
 import numpy as np
 
-from essentia import Pool
-from essentia.standard import AudioOnsetsMarker, MonoLoader, OnsetDetection
-from essentia.standard import Windowing, Spectrum, Flux, FFT, CartesianToPolar 
-from essentia.standard import FrameGenerator, Onsets, RMS
+from essentia.standard import AudioOnsetsMarker, MonoLoader, Onsets
+
+# The aubio python module runs note detection in process, otherwise the 
+# aubionotes command line utility is used.
+try:
+    import aubio
+except ImportError:
+    aubio = None
 
 # hmosaic package imports
 from hmosaic.utils import chop_to_ms, get_fixed_onsets, secs_to_samps
-from hmosaic.utils import to_mono, switch_ext
+from hmosaic.utils import to_mono, switch_ext, to_float, get_frame_matrix
+from hmosaic.cache import ContentCache
 from hmosaic.models import SegmentAudio, Unit
-from hmosaic import log
+from hmosaic import log, settings
 
 
 
@@ -51,25 +57,49 @@ class AudioSegmenter:
             
         """
         audio = SegmentAudio(filepath)
-        unit_length = chop_to_ms(audio.sample_rate, self.chop)
+        boundaries = self._fixed_boundaries(len(audio.audio_array), 
+            audio.sample_rate)
+        # Slice the audio and break into units
+        for unit_begin, unit_length in boundaries:
+            unit = audio.audio_array[unit_begin: unit_begin + unit_length]
+            yield Unit(unit, audio.sample_rate, unit_length)
+
+    def get_boundaries(self, filepath, audio=None):
+        """
+            Returns the (start, length) of each unit in samples, in the 
+            same order as ``segment`` yields them. Only the header of the 
+            file is read, so the samples in ``audio`` aren't needed.
+
+        """
+        f = Sndfile(filepath, 'r')
+        try:
+            return self._fixed_boundaries(f.nframes, f.samplerate)
+        finally:
+            f.close()
+
+    def _fixed_boundaries(self, no_samples, sample_rate):
+        """
+            Returns the (start, length) of every complete unit in audio 
+            of ``no_samples`` samples.
+
+        """
+        unit_length = chop_to_ms(sample_rate, self.chop)
         if self.hop:
             increment = int(unit_length * self.hop)
         else:
             increment = unit_length
-        # Slice the audio and break into units
-        for unit_begin in range(0, len(audio.audio_array), increment):
-            unit = audio.audio_array[unit_begin: unit_begin + unit_length]
-            if len(unit) == unit_length: # Ignore leftover samples. Who cares...
-                yield Unit(unit, audio.sample_rate, unit_length)
+        # Ignore leftover samples. Who cares...
+        return [(unit_begin, unit_length) for unit_begin in 
+            range(0, no_samples - unit_length + 1, increment)]
 
     def mark_audio(self, filepath):
         """
         """
         audio = SegmentAudio(filepath)
         onsets_all = get_fixed_onsets(self.chop, audio.length*1000)
-        print "Onsets are %s" % onsets_all
+        log.debug("Onsets are %s" % onsets_all)
         marker = AudioOnsetsMarker(onsets = onsets_all, type = 'beep')
-        marked_audio = marker(audio.audio_array.astype('single'))
+        marked_audio = marker(to_float(audio.audio_array))
         return marked_audio
                 
 
@@ -95,6 +125,10 @@ class NoteOnsetSegmenter(object):
         self.filter_audio=filter_audio
         self.aubio = aubio
         self.aubio_length = 0.2
+        if settings.ONSET_CACHE_DIR:
+            self.cache = DetectionFunctionCache(settings.ONSET_CACHE_DIR)
+        else:
+            self.cache = None
     
     def set_weights(self, weights):
         """
@@ -113,17 +147,34 @@ class NoteOnsetSegmenter(object):
             pool, audio = self._analyse(filepath)        
             onsets_all = self._convert_weights(pool)
 
-        for index, onset in enumerate(onsets_all):
-            if index == 0:
-                prev_onset = secs_to_samps(onset, self.sr)
-                continue
-            else:
-                print "Previous onset is: %d" % prev_onset
-                print "Current Onset is: %d" % secs_to_samps(onset, self.sr)
-                samps = secs_to_samps(onset, self.sr) - prev_onset
-                yield Unit(audio[prev_onset:prev_onset+samps],\
-                    self.sr, (float(samps) / float(self.sr)))
-            prev_onset = secs_to_samps(onset, self.sr)
+        for start, samps in self._onset_boundaries(onsets_all):
+            yield Unit(audio[start:start+samps],\
+                self.sr, (float(samps) / float(self.sr)))
+
+    def get_boundaries(self, filepath, audio=None):
+        """
+            Returns the (start, length) of each unit in samples, in the 
+            same order as ``segment`` yields them. If the samples of the
+            file were already read they may be passed as ``audio``, so 
+            that it isn't read again.
+
+        """
+        if self.aubio:
+            onsets_all = self._aubio_onsets(filepath)
+        else:
+            pool = self._detection_functions(filepath, audio)
+            onsets_all = self._convert_weights(pool)
+        return self._onset_boundaries(onsets_all)
+
+    def _onset_boundaries(self, onsets_all):
+        """
+            Converts onset times in seconds to the (start, length) in 
+            samples of the unit between each pair of consecutive onsets.
+
+        """
+        onsets = [secs_to_samps(onset, self.sr) for onset in onsets_all]
+        return [(prev_onset, onset - prev_onset) for prev_onset, onset in 
+            zip(onsets[:-1], onsets[1:])]
 
     def mark_audio(self, filepath):
         """
@@ -134,108 +185,146 @@ class NoteOnsetSegmenter(object):
         else:
             pool, audio = self._analyse(filepath)
             onsets_all = self._convert_weights(pool)
-        print "Onsets are %s" % onsets_all
+        log.debug("Onsets are %s" % onsets_all)
         marker = AudioOnsetsMarker(onsets = onsets_all, type = 'beep')
         marked_audio = marker(audio)
         return marked_audio
 
 
     def _convert_weights(self, pool):
-        for onset_type in pool.descriptorNames():
-            if onset_type in self.onset_weights.keys():
-                print "Onset type is: %s" % onset_type
-                print pool[onset_type]
-                print self.onset_weights[onset_type]
-        onset_list = [pool[onset_type] for onset_type in pool.descriptorNames() \
+        """
+            Combines the detection functions in ``pool``, a dictionary of 
+            arrays, into onset times using the onset weights.
+
+        """
+        onset_types = [onset_type for onset_type in sorted(pool) \
             if onset_type in self.onset_weights.keys()]
-        weights = [self.onset_weights[onset_type] for onset_type in \
-            pool.descriptorNames() if onset_type in self.onset_weights.keys()]
+        onset_list = [pool[onset_type] for onset_type in onset_types]
+        weights = [self.onset_weights[onset_type] for onset_type in onset_types]
         
         onsets = Onsets()
-        print ("Calculating onsets using these weights '%s' " % weights)
+        log.debug("Calculating onsets using these weights '%s' " % weights)
         return onsets(np.array(onset_list), weights)
 
     def _analyse(self, filepath):
+        """
+            Returns a dictionary of the onset detection functions of the 
+            audio at ``filepath`` and the audio itself.
+
+        """
         audio = to_mono(wavread(filepath)[0])
         audio = audio.astype('float32')
-        
-        w = Windowing(type = 'hann')
-        fft = FFT() # this gives us a complex FFT
-        c2p = CartesianToPolar() # and this turns it into a pair (magnitude, phase)
-        hfc_detect = OnsetDetection(method = 'hfc')
-        complex_detect = OnsetDetection(method = 'complex')
-        rms_detect = RMS()
-        spec = Spectrum()
-        #pd = PitchDetection()
-        flux = Flux()
-        pool = Pool()
-        #wap = WarpedAutoCorrelation()
-        
-    
-        # let's get down to business
-        print 'Computing onset detection functions...'
-        for frame in FrameGenerator(audio, frameSize = self.frame_size,\
-            hopSize = self.hop_size):
-            mag, phase, = c2p(fft(w(frame)))
-            spectrum = spec(w(frame))
-            f = flux(spectrum)
-            #pitch = pd(spectrum)
-            pool.add('hfc', hfc_detect(mag, phase))
-            pool.add('complex', complex_detect(mag, phase))
-            pool.add('rms', rms_detect(frame))
-            pool.add('flux', f)
-            #pool.add('pitch', pitch[0])
-        #print pool['pitch']
-        #pool.add('autoc', wap(pool['pitch']))
-     
-
-        return pool, audio
+        return self._detection_functions(filepath, audio), audio
+
+    def _detection_functions(self, filepath, audio=None):
+        """
+            Returns the onset detection functions of the audio at 
+            ``filepath`` from the cache, computing and caching them if they
+            aren't there. The audio is only read if they need computing, 
+            unless it is given, as samples of any encoding.
+
+        """
+        if self.cache:
+            key = self.cache.key(filepath, self.frame_size, self.hop_size, 
+                self.sr)
+            pool = self.cache.load(key)
+            if pool is not None:
+                log.debug("Using cached onset detection functions for '%s'"
+                    % filepath)
+                return pool
+        if audio is None:
+            audio = wavread(filepath)[0]
+        audio = to_mono(to_float(audio))
+        log.debug('Computing onset detection functions...')
+        detector = DetectionFunctions(self.frame_size, self.hop_size, self.sr)
+        pool = detector.compute(audio)
+        if self.cache:
+            self.cache.store(key, pool)
+        return pool
 
     def _aubio_onsets(self, filepath):
         """
-            Uses the aubionotes command line utility to do note segmentation.
+            Uses aubio to do note segmentation. Notes shorter than 
+            ``aubio_length`` are merged into the following ones, and the 
+            sorted onset times in seconds are returned.
 
         """
-        
-        command = ['aubionotes','-i', filepath, '-t', '0.9' ]
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, \
-        stderr = subprocess.PIPE)
-        (stdout, stderr) = process.communicate()
-        
-        # Don't know what happpens when this yoke throws an error
-        print stdout
-        print len(stdout)
-        numbers = stdout.split('\n')
+        if aubio is None:
+            notes = self._aubionotes_command(filepath)
+        else:
+            notes = self._aubio_notes(filepath)
+        log.debug("Aubio found %d notes in '%s'" % (len(notes), filepath))
         onsets = set()
         prev_note = 0
-        skipped=False
-        for n in numbers:
-            print ("Is this A NUMBER? :%s" %n)
-            no_list = n.split()
-            if len(no_list) == 3:
-                print float(no_list[2]) - float(no_list[1])
-                if prev_note == 0:
-                    onsets.add(float(no_list[1]))
-                    prev_note = float(no_list[1])
-                if float(no_list[2]) - prev_note < self.aubio_length:
-                    print("Note is too small, lets merge.")
-                    #prev_note = float(no_list[1])
-                    #onsets.add(float(no_list[1]))
-                    skipped =  True
-                else:
-                    print ("This is data I can use!!: %s" % no_list)
-                    if not skipped:
-                        onsets.add(float(no_list[1]))
-                    onsets.add(float(no_list[2]))
-                    skipped=False
-                    prev_note = float(no_list[2])
+        skipped = False
+        for start, end in notes:
+            if prev_note == 0:
+                onsets.add(start)
+                prev_note = start
+            if end - prev_note < self.aubio_length:
+                # Note is too small, merge it with the next one.
+                skipped = True
+            else:
+                if not skipped:
+                    onsets.add(start)
+                onsets.add(end)
+                skipped = False
+                prev_note = end
         onset_list = list(onsets)
         onset_list.sort()
-        print ("Onsets are: %s" % onset_list)
         return onset_list
 
+    def _aubio_notes(self, filepath, buf_size=512, hop_size=256):
+        """
+            Runs aubio's note detection in process. Returns the (start, end)
+            time in seconds of each note as the rows of an array.
+
+        """
+        source = aubio.source(filepath, 0, hop_size)
+        detector = aubio.notes('default', buf_size, hop_size, 
+            source.samplerate)
+        notes = []
+        start = None
+        frames_read = 0
+        try:
+            while True:
+                samples, read = source()
+                (note_on, velocity, note_off) = detector(samples)[:3]
+                if note_off != 0 and start is not None:
+                    notes.append((start, frames_read))
+                    start = None
+                if note_on != 0:
+                    start = frames_read
+                frames_read += read
+                if read < hop_size:
+                    break
+        finally:
+            source.close()
+        if start is not None:
+            notes.append((start, frames_read))
+        return np.array(notes, dtype=float).reshape((-1, 2)) / \
+            source.samplerate
+
+    def _aubionotes_command(self, filepath):
+        """
+            Runs the aubionotes command line utility, for when the aubio 
+            module isn't installed. Returns the (start, end) time in 
+            seconds of each note as the rows of an array.
+
+        """
+        command = ['aubionotes','-i', filepath, '-t', '0.9' ]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, \
+        stderr = subprocess.PIPE)
+        (stdout, stderr) = process.communicate()
+        if process.returncode != 0:
+            log.error("aubionotes failed on '%s': %s" % (filepath, stderr))
+        # Each note is a line of 'pitch start end'.
+        fields = [line.split() for line in stdout.splitlines()]
+        return np.array([f[1:] for f in fields if len(f) == 3], 
+            dtype=float).reshape((-1, 2))
+
     def write_aubio_onsets(self, onset_list, filepath):
-        print ("Onsets are :%s" % onset_list)
+        log.debug("Onsets are :%s" % onset_list)
         audio = MonoLoader(filename=filepath)()
         marker = AudioOnsetsMarker(onsets = onset_list, type = 'beep')
         marked_audio = marker(audio)
@@ -243,3 +332,415 @@ class NoteOnsetSegmenter(object):
             'AUBIOONSETS.wav'), 44100)
     
 
+
+class StreamingOnsetSegmenter(NoteOnsetSegmenter):
+    """
+        An onset segmenter which reads the audio in blocks and yields each
+        unit as soon as the onset ending it has been confirmed, so that
+        memory and start up time don't grow with the length of the file.
+        Onsets are picked by an ``OnsetPicker`` from the same detection 
+        functions and weights as the ``NoteOnsetSegmenter``, but since the 
+        whole file is never seen at once they are normalised by their 
+        running maxima rather than their global maxima, so the onsets are 
+        close to but not always the same as those of ``Onsets``.
+        Aubio is not supported.
+
+    """
+
+    def __init__(self, sr=44100, frame_size=4096, hop_size=512,
+        onset_weights=NoteOnsetSegmenter.defaults, block_size=65536, 
+        delay=5, alpha=0.1, silence_threshold=0.02):
+        """
+            ``block_size`` is the number of samples read at a time. 
+            ``delay``, ``alpha`` and ``silence_threshold`` are passed to
+            the ``OnsetPicker``, which looks ahead ``delay`` + 1 frames.
+
+        """
+        NoteOnsetSegmenter.__init__(self, sr, frame_size, hop_size, 
+            onset_weights)
+        self.block_size = block_size
+        self.delay = delay
+        self.alpha = alpha
+        self.silence_threshold = silence_threshold
+
+    def segment(self, filepath):
+        """
+            Yields a ``Unit`` for the audio between each pair of 
+            consecutive onsets, as they are found.
+
+        """
+        lookahead = self.frame_size + (self.delay + 1) * self.hop_size
+        blocks = []
+        buffer_start = 0
+        prev_onset = None
+        for block, onsets in self._stream(filepath):
+            blocks.append(block)
+            for onset in onsets:
+                if prev_onset is not None:
+                    audio = np.concatenate(blocks)
+                    samps = onset - prev_onset
+                    yield Unit(audio[prev_onset - buffer_start:
+                        onset - buffer_start], self.sr, 
+                        (float(samps) / float(self.sr)))
+                    blocks = [audio[onset - buffer_start:]]
+                else:
+                    blocks = [np.concatenate(blocks)[onset - buffer_start:]]
+                buffer_start = onset
+                prev_onset = onset
+            if prev_onset is None and len(blocks):
+                # Before the first onset only the audio which could still
+                # follow a late confirmed onset is kept.
+                audio = np.concatenate(blocks)
+                keep = max(len(audio) - lookahead, 0)
+                buffer_start += keep
+                blocks = [audio[keep:]]
+
+    def get_boundaries(self, filepath, audio=None):
+        """
+            Returns the (start, length) of each unit in samples, in the 
+            same order as ``segment`` yields them. If the samples of the
+            file were already read they may be passed as ``audio``, and 
+            are streamed from memory rather than the file.
+
+        """
+        onsets = [onset for block, block_onsets in 
+            self._stream(filepath, audio) for onset in block_onsets]
+        return zip(onsets[:-1], np.diff(onsets).tolist())
+
+    def mark_audio(self, filepath):
+        """
+            Returns the audio with the onsets marked by beeps.
+
+        """
+        onsets_all = [float(onset) / self.sr for block, block_onsets in 
+            self._stream(filepath) for onset in block_onsets]
+        audio = to_mono(wavread(filepath)[0]).astype('float32')
+        marker = AudioOnsetsMarker(onsets = onsets_all, type = 'beep')
+        return marker(audio)
+
+    def _stream(self, filepath, audio=None):
+        """
+            Reads the audio at ``filepath``, or the samples in ``audio`` 
+            if given, a block at a time. Yields each mono block along with
+            the onsets (in samples) which were confirmed after reading it.
+            The frames are those of ``DetectionFunctions.compute``, frame n
+            is centred on sample n * ``hop_size``.
+
+        """
+        detector = DetectionFunctions(self.frame_size, self.hop_size, self.sr)
+        picker = OnsetPicker(self.onset_weights, self.delay, self.alpha, 
+            self.silence_threshold)
+        no_samples = 0
+        no_frames = 0
+        # Samples from the start of the next frame onwards.
+        pending = np.zeros(self.frame_size / 2, 'float32')
+        for block in self._read_blocks(filepath, audio):
+            no_samples += len(block)
+            pending = np.concatenate((pending, block))
+            frames = get_frame_matrix(pending, self.frame_size, 
+                self.hop_size)
+            onsets = []
+            if len(frames):
+                onsets = picker.push(detector.process(frames))
+                no_frames += len(frames)
+                pending = pending[len(frames) * self.hop_size:]
+            yield block, self._to_samples(onsets, no_samples)
+        # Frames continue, zero padded, until one is centred past the end.
+        missing = 0
+        if no_samples:
+            missing = -(-no_samples / self.hop_size) + 1 - no_frames
+        onsets = []
+        if missing > 0:
+            pending = np.concatenate((pending, np.zeros((missing - 1) * 
+                self.hop_size + self.frame_size - len(pending), 'float32')))
+            frames = get_frame_matrix(pending, self.frame_size, self.hop_size)
+            onsets = picker.push(detector.process(frames[:missing]))
+        onsets.extend(picker.flush())
+        yield np.zeros(0, 'float32'), self._to_samples(onsets, no_samples)
+
+    def _read_blocks(self, filepath, audio=None):
+        """
+            Yields the mono samples of the file at ``filepath`` as 32bit 
+            floats, ``block_size`` at a time, or those of ``audio`` if the
+            file was already read.
+
+        """
+        if audio is not None:
+            for start in range(0, len(audio), self.block_size):
+                yield to_mono(to_float(audio[start:start + self.block_size]))
+            return
+        f = Sndfile(filepath, 'r')
+        try:
+            remaining = f.nframes
+            while remaining > 0:
+                block = to_mono(f.read_frames(min(self.block_size, remaining),
+                    dtype=np.float32))
+                remaining -= len(block)
+                yield block
+        finally:
+            f.close()
+
+    def _to_samples(self, frames, no_samples):
+        """ Converts onset frames to samples, within the audio read. """
+
+        return [min(frame * self.hop_size, no_samples) for frame in frames]
+
+
+class DetectionFunctions(object):
+    """
+        Computes the onset detection functions used by the 
+        ``NoteOnsetSegmenter`` for whole blocks of frames at once with numpy,
+        giving the same values as running essentia's ``OnsetDetection`` 
+        ('hfc' and 'complex'), ``RMS`` and ``Flux`` on each frame from a 
+        ``FrameGenerator``:
+         *  ``hfc`` - sum of the magnitude spectrum weighted by frequency.
+         *  ``complex`` - distance of the spectrum from the one predicted
+            by the previous two frames, in magnitude and phase.
+         *  ``rms`` - root mean square of the unwindowed frame.
+         *  ``flux`` - L2 norm of the change in the magnitude spectrum.
+        The detector keeps the last frames it has seen, so consecutive 
+        blocks can be passed to ``process`` as they are read.
+
+    """
+
+    names = ['complex', 'flux', 'hfc', 'rms']
+
+    def __init__(self, frame_size=4096, hop_size=512, sample_rate=44100):
+        """
+            The window is essentia's normalised hann window. Its zero phase
+            rotation, by half a frame, is left out. It only flips the sign
+            of the odd bins of the spectrum, which is taken into account 
+            where the complex detection function needs phase.
+
+        """
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        self.sample_rate = sample_rate
+        window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_size) / 
+            (frame_size - 1))
+        self.window = window * 2.0 / window.sum()
+        bins = frame_size / 2 + 1
+        self.bin_freqs = np.arange(bins) * (sample_rate / 2.0 / (bins - 1))
+        self.bin_signs = np.where(np.arange(bins) % 2, -1.0, 1.0)
+        self.reset()
+
+    def reset(self):
+        """ Forgets the previous frames, as if starting a new file. """
+
+        bins = len(self.bin_freqs)
+        self._spectra = np.zeros((2, bins), 'complex64')
+        self._mags = np.zeros((2, bins), 'float32')
+
+    def compute(self, audio, block_size=64):
+        """
+            Returns the detection functions for the whole of ``audio``,
+            framed like essentia's ``FrameGenerator``: the first frame is
+            centred on the first sample and frames continue until one is
+            centred past the end, with zeros padding either end.
+
+        """
+        self.reset()
+        if len(audio) == 0:
+            return dict((name, np.zeros(0, 'float32')) for name in self.names)
+        no_frames = -(-len(audio) / self.hop_size) + 1
+        half = self.frame_size / 2
+        tail = max(0, (no_frames - 1) * self.hop_size + half - len(audio))
+        padded = np.concatenate((np.zeros(half), audio, np.zeros(tail)))
+        frames = get_frame_matrix(padded, self.frame_size, self.hop_size)
+        blocks = [self.process(frames[start:start + block_size]) for start 
+            in range(0, no_frames, block_size)]
+        return dict((name, np.concatenate([block[name] for block in blocks])) 
+            for name in self.names)
+
+    def process(self, frames):
+        """
+            Returns the detection functions for a block of consecutive 
+            ``frames``, one frame per row, continuing from the last block.
+
+        """
+        frames = np.asarray(frames, dtype=float)
+        spectrum = np.fft.rfft(frames * self.window, axis=1)
+        mag = np.abs(spectrum)
+        rms = np.sqrt((frames ** 2).mean(axis=1))
+        hfc = mag.dot(self.bin_freqs)
+
+        mags = np.concatenate((self._mags, mag.astype('float32')))
+        change = mags[2:] - mags[1:-1]
+        flux = np.sqrt((change ** 2).sum(axis=1))
+
+        # The predicted spectrum keeps the previous magnitude and continues 
+        # the phase from the two previous frames: 
+        # X[n-1]**2 * conj(X[n-2]) / (|X[n-1]| * |X[n-2]|). A silent bin 
+        # (including those before the first frame) has a phase of 0 in the 
+        # rotated spectrum, i.e. a unit phasor of the bin's sign here.
+        spectra = np.concatenate((self._spectra, spectrum.astype('complex64')))
+        silent = mags == 0
+        scale = 1.0 / ((mags[1:-1] + silent[1:-1]) * (mags[:-2] + silent[:-2]))
+        before = spectra[:-2].conj()
+        before += silent[:-2] * self.bin_signs
+        predicted = spectra[1:-1] * spectra[1:-1]
+        predicted *= before
+        predicted *= scale
+        predicted -= spectra[2:]
+        complex_domain = np.abs(predicted).sum(axis=1)
+
+        self._spectra = spectra[-2:]
+        self._mags = mags[-2:]
+        return {
+            'complex': complex_domain.astype('float32'),
+            'flux': flux.astype('float32'),
+            'hfc': hfc.astype('float32'),
+            'rms': rms.astype('float32')
+        }
+
+
+class DetectionFunctionCache(ContentCache):
+    """
+        A content addressed store of onset detection functions, so that 
+        changing the onset weights only recombines them. Each entry is 
+        keyed on the hash of the audio and the frame size, hop size and 
+        sample rate, and holds the functions of ``DetectionFunctions`` in 
+        a .npz file.
+
+    """
+
+    def __init__(self, location):
+        ContentCache.__init__(self, location, '.npz')
+
+    def key(self, audio_filepath, frame_size, hop_size, sample_rate):
+        """
+            Returns the cache key for the detection functions of 
+            ``audio_filepath`` computed with the given framing.
+
+        """
+        return hashlib.sha1('%s:%d:%d:%d' % (self.hash_file(audio_filepath), 
+            frame_size, hop_size, sample_rate)).hexdigest()
+
+    def load(self, key):
+        """
+            Returns the dictionary of detection functions stored under 
+            ``key``, or None if there is no entry.
+
+        """
+        cached = self.lookup(key)
+        if cached is None:
+            return None
+        entry = np.load(cached)
+        try:
+            return dict((name, entry[name]) for name in entry.files)
+        finally:
+            entry.close()
+
+    def store(self, key, functions):
+        """
+            Adds the dictionary of detection ``functions`` to the cache 
+            under ``key``.
+
+        """
+        self.write(key, lambda f: np.savez(f, **functions))
+
+
+class OnsetPicker(object):
+    """
+        Picks onsets from a stream of detection functions, in the manner of
+        essentia's ``Onsets``. Each function is normalised by its running 
+        maximum, and they are combined using the onset weights. The 
+        threshold of each frame is the median plus ``alpha`` times the 
+        mean of the last ``delay`` combined values, and a frame is an onset
+        if the amount it exceeds its threshold by is above the silence 
+        threshold and is a peak. A frame is normalised by the maximum
+        up to ``delay`` frames after it, so onsets are confirmed 
+        ``delay`` + 1 frames late.
+
+    """
+
+    def __init__(self, onset_weights, delay=5, alpha=0.1, 
+        silence_threshold=0.02):
+        """
+            Functions with no weight are ignored.
+
+        """
+        self.names = [name for name in sorted(onset_weights) 
+            if onset_weights[name]]
+        weights = np.array([onset_weights[name] for name in self.names], 
+            dtype=float)
+        self.weights = weights / max(weights.sum(), 1e-20)
+        self.delay = delay
+        self.alpha = alpha
+        self.silence_threshold = silence_threshold
+        self._maxima = np.zeros(len(self.names))
+        self._raw = np.zeros((len(self.names), 0))
+        # The last ``delay`` - 1 combined values, silence before the start.
+        self._history = np.zeros(delay - 1)
+        # Values above threshold from the last frame which was decided.
+        self._excess = np.zeros(1)
+        self._next_frame = 0
+
+    def push(self, functions):
+        """
+            Adds a block of frames, ``functions`` being a dictionary of 
+            detection functions like that of ``DetectionFunctions``. Returns
+            the frame numbers of the onsets which have been confirmed.
+
+        """
+        new = np.array([functions[name] for name in self.names], dtype=float)
+        if new.shape[1] == 0:
+            return []
+        # The running maximum at each new frame.
+        maxima = np.maximum.accumulate(np.column_stack((self._maxima, new)), 
+            axis=1)[:, 1:]
+        self._maxima = maxima[:, -1]
+        raw = np.column_stack((self._raw, new))
+        # A frame is normalised by the maximum ``delay`` frames later.
+        ready = max(raw.shape[1] - self.delay, 0)
+        first = new.shape[1] - raw.shape[1] + self.delay
+        self._threshold(raw[:, :ready], maxima[:, first:first + ready])
+        self._raw = raw[:, ready:]
+        return self._pick(flush=False)
+
+    def flush(self):
+        """
+            Decides the remaining frames at the end of the stream and 
+            returns their onsets.
+
+        """
+        ready = self._raw.shape[1]
+        self._threshold(self._raw, np.tile(self._maxima[:, np.newaxis], 
+            (1, ready)))
+        self._raw = np.zeros((len(self.names), 0))
+        return self._pick(flush=True)
+
+    def _threshold(self, raw, maxima):
+        """
+            Combines the normalised functions and keeps the amount each 
+            frame exceeds its threshold by.
+
+        """
+        maxima = np.where(maxima > 0, maxima, 1.0)
+        combined = self.weights.dot(raw / maxima)
+        values = np.concatenate((self._history, combined))
+        windows = get_frame_matrix(values, self.delay, 1)
+        threshold = np.median(windows, axis=1) + \
+            self.alpha * windows.mean(axis=1)
+        excess = np.where(combined > threshold, combined - threshold, 0.0)
+        self._history = values[len(values) - self.delay + 1:]
+        self._excess = np.concatenate((self._excess, excess))
+
+    def _pick(self, flush):
+        """
+            Decides every frame whose successor is known, or all of them
+            when flushing.
+
+        """
+        excess = self._excess
+        if flush:
+            excess = np.concatenate((excess, np.zeros(1)))
+        if len(excess) < 3:
+            return []
+        values = excess[1:-1]
+        peaks = (values > self.silence_threshold) & \
+            (values > excess[:-2]) & (values >= excess[2:])
+        onsets = (np.nonzero(peaks)[0] + self._next_frame).tolist()
+        self._next_frame += len(values)
+        self._excess = self._excess[len(values):]
+        return onsets
@@ -26,6 +26,87 @@ ESSENTIA_BIN_DIR =  os.path.join(os.path.dirname(__file__), 'analyser')
 # Names of the analyser binary to use
 DEFAULT_ANALYSER = 'streaming_extractor'
 
+# Analyser used for units. 'essentia' runs the binary above on each unit,
+# 'numpy' computes only the low level descriptors used for unit search, in 
+# process, which is much faster. Corpus and target units must be analysed
+# by the same analyser, mosaicing refuses to mix them.
+UNIT_ANALYSER = 'essentia'
+
+# Number of units to analyse in parallel when analysing a batch of units. 
+# None means one per cpu.
+ANALYSIS_WORKERS = None
+
+# Number of processes parsing .yaml analysis files when many are read at 
+# once, e.g. for experiment reports. None means one per cpu.
+ANALYSIS_READ_WORKERS = None
+
+# Number of audio files to segment in parallel, each in its own process.
+# None means one per cpu.
+SEGMENTATION_WORKERS = None
+
+# Directory holding the caches below, in the user's cache directory rather
+# than the package, which may not be writable.
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or 
+    os.path.expanduser(os.path.join('~', '.cache')), 'hmosaic')
+
+# Directory in which analysis is cached. Entries are keyed on a hash of the 
+# audio content and the analyser binary, so unchanged units are not analysed 
+# again and identical audio is only analysed once across all corpora.
+# None disables the cache, set it to e.g. os.path.join(CACHE_DIR, 'analysis')
+# to enable it.
+ANALYSIS_CACHE_DIR = None
+
+# Directory in which onset detection functions are cached, keyed on a hash
+# of the audio content and the frame and hop sizes, so that trying new onset
+# weights on a file only recombines them. None disables the cache, set it to
+# e.g. os.path.join(CACHE_DIR, 'onsets') to enable it.
+ONSET_CACHE_DIR = None
+
+# Size in megabytes each of the caches above is pruned to after a run of 
+# analysis or segmentation, least recently used entries first. Entries in 
+# the index of file hashes for files which have since changed or gone are 
+# always pruned. None means no limit.
+CONTENT_CACHE_SIZE = 2048
+
+# Seconds an analyser binary may run on a single file before it is killed.
+# Set to None to wait forever.
+ANALYSIS_TIMEOUT = 300
+
+# Further seconds an analyser binary may run for each second of audio in the
+# file, so that whole source files get more time than their units.
+ANALYSIS_TIMEOUT_PER_SECOND = 1.0
+
+# Number of times to run the analyser binary again on a file after it timed 
+# out or crashed. Errors reported by the binary itself are not retried.
+ANALYSIS_RETRIES = 1
+
+# Store segmentations as an index of unit boundaries in the source audio
+# rather than writing a wav file for each unit. Units are then read from the
+# source file when they are needed.
+VIRTUAL_UNITS = False
+
+# Segment by onsets with the StreamingOnsetSegmenter, which reads the audio
+# in blocks rather than all at once. Its onsets can differ slightly from 
+# those of the NoteOnsetSegmenter.
+STREAMING_ONSETS = False
+
+# Split the gaia dataset of a chop into shards of at most this many units.
+# Gaia slows down with more than about 30000 units in a DataSet. The 
+# normalisation of the shards is learned from at most this many units, and
+# only the shards holding changed units are built again. Set to None to 
+# keep all units of a chop in one DataSet.
+GAIA_SHARD_SIZE = None
+
+# Number of processes searching the shards of a dataset, each loads its 
+# share of the shards once. None means one per cpu, 1 searches the shards 
+# in the mosaicing process itself.
+GAIA_SEARCH_WORKERS = None
+
+# Megabytes of gaia datasets, with their distances and views, to keep in 
+# memory between mosaics. Datasets are reloaded when their file changes and
+# the least recently used are dropped first. Set to None to disable.
+GAIA_CACHE_SIZE = 1024
+
 
 # File logging logs to a file, screen logging logs to the terminal window 
 # where the process was started.
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded gaia datasets for corpora with too many units for a single DataSet.
+The units of a chop are split into shards of at most ``GAIA_SHARD_SIZE``
+units, each saved as its own DataSet, with an index of the units in each
+shard
+
+    corpus_name
+        ---> unit_ds_500.json
+        ---> unit_ds_500.history
+        ---> unit_ds_500.shards.json
+        ---> unit_ds_500.shard_000.db
+        ---> unit_ds_500.shard_001.db
+        ...
+
+Every shard is built from the analysis files of its own units, mapped
+through the same transformation history, so all shards share its layout
+and normalisation. A point mapped through the history can be searched in
+all of them, and the distances found in different shards can be compared.
+Units keep their shard when the dataset is updated, so only the shards
+holding new, modified or removed units are built again.
+
+A search is fanned out to ``GAIA_SEARCH_WORKERS`` processes, each of which
+loads its own share of the shards once. The mapped point is sent to each of
+them and only the closest points of each come back to be merged.
+
+"""
+
+# Standard library imports
+import os
+import json
+import heapq
+import threading
+from multiprocessing import Pipe, Process, cpu_count
+
+# Third party library imports
+from gaia2 import DataSet, Point, TransformationHistory, View
+
+# hmosaic package imports
+from hmosaic import log, settings
+from hmosaic.utils import atomic_write
+
+# Version of the shard index, an index of another version is rebuilt.
+SHARD_INDEX_VERSION = 2
+
+
+class ShardSearchError(Exception):
+    """ Thrown when a worker process fails to search its shards. """
+
+    pass
+
+
+class ShardedDataSet(object):
+    """
+        A read only gaia DataSet made of several shards. It provides the
+        part of the DataSet interface used when searching for units. Only
+        the first shard is loaded in this process, for the layout, the
+        others are loaded by whichever process searches them.
+
+    """
+
+    def __init__(self, filepaths, names, history_location):
+        """
+            ``filepaths`` are the shards, all with the same layout and
+            history, ``names`` the list of the names of the points in
+            each of them and ``history_location`` where their history is
+            saved.
+
+        """
+        self.filepaths = filepaths
+        self.names = names
+        self._history = TransformationHistory()
+        self._history.load(history_location)
+        self._first = None
+
+    def __len__(self):
+        return sum(len(names) for names in self.names)
+
+    def size(self):
+        return len(self)
+
+    def layout(self):
+        if self._first is None:
+            self._first = _load_dataset(self.filepaths[0])
+        return self._first.layout()
+
+    def history(self):
+        return self._history
+
+    def pointNames(self):
+        names = []
+        for shard_names in self.names:
+            names.extend(shard_names)
+        return names
+
+    def contains(self, name):
+        return any(name in shard_names for shard_names in self.names)
+
+    def point(self, name):
+        for (filepath, shard_names) in zip(self.filepaths, self.names):
+            if name in shard_names:
+                return _load_dataset(filepath).point(name)
+        raise KeyError("No point named '%s' in any shard" % name)
+
+
+class ShardedView(object):
+    """
+        Nearest neighbour search over a ``ShardedDataSet``. Like a gaia
+        View, ``nnSearch`` returns an object whose ``get(k)`` returns the
+        ``k`` closest (name, distance) pairs, here merged from the closest
+        ``k`` of every shard. The shards are searched by ``workers``
+        processes, started with the view and stopped by ``close``.
+
+    """
+
+    def __init__(self, dataset, distance, workers=None):
+        """
+            ``distance`` is created for the layout of the shards, which
+            they all share. The worker processes are forked with it, as
+            gaia distances can't be pickled. ``workers`` defaults to
+            ``settings.GAIA_SEARCH_WORKERS``, or one per cpu if that is
+            None, and is at most the number of shards. A single worker
+            searches the shards in this process.
+
+        """
+        self.dataset = dataset
+        self._views = None
+        self._workers = []
+        self._lock = threading.Lock()
+        if workers is None:
+            workers = settings.GAIA_SEARCH_WORKERS or cpu_count()
+        workers = max(min(workers, len(dataset.filepaths)), 1)
+        if workers == 1:
+            self._views = [View(_load_dataset(filepath), distance)
+                for filepath in dataset.filepaths]
+            return
+        for i in range(workers):
+            (connection, worker_connection) = Pipe()
+            process = Process(target=_search_shards, args=(worker_connection,
+                dataset.filepaths[i::workers], distance))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            self._workers.append((process, connection))
+
+    def __del__(self):
+        self.close()
+
+    def nnSearch(self, point):
+        return ShardedSearch(self, point)
+
+    def search(self, point, k):
+        """
+            Returns the ``k`` points of all the shards which are closest
+            to ``point``, as a list of (name, distance) pairs.
+
+        """
+        if self._views is not None:
+            results = [view.nnSearch(point).get(k) for view in self._views]
+        else:
+            results = self._fan_out(point.toBase64(), k)
+        return heapq.nsmallest(k, (r for result in results for r in result),
+            key=lambda r: r[1])
+
+    def close(self):
+        """ Stops the worker processes, the view can't be searched after. """
+
+        workers = self._workers
+        self._workers = []
+        for (process, connection) in workers:
+            try:
+                connection.send(None)
+            except (IOError, EOFError):
+                pass
+            connection.close()
+        for (process, connection) in workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+    def _fan_out(self, point_state, k):
+        """
+            Sends the serialised point to every worker and returns the
+            closest ``k`` points each of them found. Searches from several
+            threads are taken in turn. The workers are stopped if one of
+            them dies, as the replies of the others can't be matched to
+            their requests any more.
+
+        """
+        self._lock.acquire()
+        try:
+            if len(self._workers) == 0:
+                raise ShardSearchError("The shard workers have been stopped")
+            try:
+                for (process, connection) in self._workers:
+                    connection.send((point_state, k))
+                replies = [connection.recv() for (process, connection)
+                    in self._workers]
+            except (IOError, EOFError), e:
+                self.close()
+                raise ShardSearchError("A shard worker died: %s" % e)
+        finally:
+            self._lock.release()
+        for (results, error) in replies:
+            if error is not None:
+                raise ShardSearchError(error)
+        return [results for (results, error) in replies]
+
+
+class ShardedSearch(object):
+    """
+        The pending results of a search of a ``ShardedView``.
+
+    """
+
+    def __init__(self, view, point):
+        self.view = view
+        self.point = point
+
+    def get(self, k):
+        return self.view.search(self.point, k)
+
+
+def get_view(dataset, distance):
+    """
+        Returns a view for searching ``dataset``, which may be a gaia
+        DataSet or a ``ShardedDataSet``.
+
+    """
+    if isinstance(dataset, ShardedDataSet):
+        return ShardedView(dataset, distance)
+    return View(dataset, distance)
+
+def get_shards_location(db_location):
+    """
+        Returns the location of the shard index of the gaia dataset which
+        would be at ``db_location``.
+
+    """
+    return os.path.splitext(db_location)[0] + '.shards.json'
+
+def has_shards(db_location, shard_size, history_location):
+    """
+        Returns True if the shards of the dataset at ``db_location`` have
+        been built with ``shard_size`` and the history now saved at 
+        ``history_location``, and are all there.
+
+    """
+    index = _load_shard_index(get_shards_location(db_location))
+    return index is not None and index['size'] == shard_size and \
+        index['history'] == _get_mtime(history_location) and \
+            all(os.path.isfile(filepath) for filepath in
+                _get_shard_filepaths(db_location, index['shards']))
+
+def load_shards(db_location, history_location):
+    """
+        Returns a ``ShardedDataSet`` of the shards of the gaia dataset at
+        ``db_location``, which have a history saved at
+        ``history_location``. None if there are no shards.
+
+    """
+    index = _load_shard_index(get_shards_location(db_location))
+    if index is None:
+        return None
+    return ShardedDataSet(_get_shard_filepaths(db_location, index['shards']),
+        [sorted(shard['units']) for shard in index['shards']], 
+        history_location)
+
+def write_shards(db_location, shard_size, mtimes, history_location):
+    """
+        Builds the shards of the gaia dataset at ``db_location`` for the
+        analysis files which are the keys of ``mtimes``, with their
+        modification times. The shard index records the modification time
+        of the units in each shard when it was built. Units stay in their
+        shard, new units fill the shards with room and then new shards of
+        at most ``shard_size`` units. Only the shards with new, modified or
+        removed units are built again, each from the analysis files of its
+        own units mapped through the history saved at 
+        ``history_location``, unless the history has changed, when all of
+        them are. Returns the shard index, which is written last.
+
+    """
+    shards_location = get_shards_location(db_location)
+    history_mtime = _get_mtime(history_location)
+    index = _load_shard_index(shards_location)
+    old_filepaths = []
+    if index is not None:
+        old_filepaths = _get_shard_filepaths(db_location, index['shards'])
+    if index is None or index['size'] != shard_size:
+        index = {'version': SHARD_INDEX_VERSION, 'size': shard_size,
+            'history': history_mtime, 'shards': []}
+    shards = index['shards']
+    stale = set()
+    placed = set()
+    for (i, shard) in enumerate(shards):
+        units = dict((u, mtime) for (u, mtime) in shard['units'].items() 
+            if mtimes.get(u) == mtime)
+        if len(units) < len(shard['units']) or \
+            index['history'] != history_mtime or \
+                not os.path.isfile(old_filepaths[i]):
+            stale.add(i)
+        shard['units'] = units
+        placed.update(units)
+    index['history'] = history_mtime
+    new = sorted(u for u in mtimes if u not in placed)
+    for (i, shard) in enumerate(shards):
+        room = shard_size - len(shard['units'])
+        if room > 0 and len(new) > 0:
+            shard['units'].update((u, mtimes[u]) for u in new[:room])
+            new = new[room:]
+            stale.add(i)
+    number = max([int(shard['name'].split('_')[-1]) for shard in shards]
+        + [-1]) + 1
+    while len(new) > 0:
+        stale.add(len(shards))
+        shards.append({'name': 'shard_%03d' % number,
+            'units': dict((u, mtimes[u]) for u in new[:shard_size])})
+        new = new[shard_size:]
+        number += 1
+    if len(stale) == 0:
+        log.debug("The shards of '%s' are up to date" % db_location)
+        return index
+    stale = set(shards[i]['name'] for i in stale)
+    index['shards'] = [shard for shard in shards if len(shard['units']) > 0]
+    filepaths = _get_shard_filepaths(db_location, index['shards'])
+    rebuild = [filepath for (filepath, shard) in zip(filepaths, 
+        index['shards']) if shard['name'] in stale]
+    log.debug("Building %d of the %d shards of the %d units of '%s'"
+        % (len(rebuild), len(index['shards']), len(mtimes), db_location))
+    # The index goes first, so shards being built are never loaded.
+    if os.path.isfile(shards_location):
+        os.remove(shards_location)
+    history = TransformationHistory()
+    history.load(history_location)
+    for (filepath, shard) in zip(filepaths, index['shards']):
+        if filepath not in rebuild:
+            continue
+        ds = DataSet()
+        for name in sorted(shard['units']):
+            p = Point()
+            p.load(name)
+            p.setName(name)
+            ds.addPoint(p)
+        history.mapDataSet(ds).save(filepath)
+    atomic_write(shards_location, lambda f: json.dump(index, f), 'w')
+    for filepath in set(old_filepaths) - set(filepaths):
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+    return index
+
+def _search_shards(connection, filepaths, distance):
+    """
+        Runs in a worker process, searching the shards at ``filepaths``
+        for each (serialised point, k) request received on
+        ``connection`` until it receives None. Replies with the closest
+        ``k`` points of its shards, or the error if the search failed.
+
+    """
+    views = [View(_load_dataset(filepath), distance)
+        for filepath in filepaths]
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        (point_state, k) = request
+        try:
+            point = Point()
+            point.fromBase64(point_state)
+            results = [r for view in views for r in view.nnSearch(point).get(k)]
+            reply = (heapq.nsmallest(k, results, key=lambda r: r[1]), None)
+        except Exception, e:
+            reply = (None, '%s: %s' % (e.__class__.__name__, e))
+        connection.send(reply)
+    connection.close()
+
+def _get_mtime(filepath):
+    """ Returns the modification time of ``filepath``, None if missing. """
+
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return None
+
+def _load_dataset(filepath):
+    ds = DataSet()
+    ds.load(filepath)
+    return ds
+
+def _get_shard_filepaths(db_location, shards):
+    base = os.path.splitext(db_location)[0]
+    return ['%s.%s.db' % (base, shard['name']) for shard in shards]
+
+def _load_shard_index(shards_location):
+    """ Returns the shard index, None if there is none. """
+
+    if not os.path.isfile(shards_location):
+        return None
+    f = open(shards_location)
+    try:
+        index = json.load(f)
+    except ValueError:
+        log.warn("Ignoring the corrupt shard index '%s'" % shards_location)
+        return None
+    finally:
+        f.close()
+    if index.get('version') != SHARD_INDEX_VERSION:
+        return None
+    return index
@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+"""
+A compact columnar store for the analysis of the units of one segmentation
+scheme (``chop``) of a corpus. Instead of one .yaml file per unit, each
+numeric descriptor is kept as a single .npy column with one row per unit,
+so that only the descriptors which are needed are read and they can be
+memory mapped. A store is a directory which looks like this
+
+    units_500.store
+        ---> schema.yaml
+        ---> units.npy
+        ---> lowlevel.pitch.mean.npy
+        ---> lowlevel.spectral_energy.mean.npy
+        ---> lowlevel.mfcc.mean.npy
+        ...
+
+``schema.yaml`` lists the descriptor names and the shape of a single value
+of each, and the modification time of the newest .yaml file imported, so 
+that a store which is out of date can be found. ``units.npy`` holds the
+filepaths of the units, relative to the root of the store (usually the 
+corpus), in row order.
+Descriptors are named by joining the keys of the nested analysis with '.'
+as gaia does. Only numeric descriptors of the same shape for every unit
+can be stored, others (strings, variable length lists) are left out.
+
+The same descriptors can also be exported as a ``FeatureMatrix``, a single
+float32 matrix with a row per unit, for vectorised queries over all units.
+
+"""
+
+# Standard library imports
+import os
+import json
+import errno
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
+
+# Third party library imports
+import numpy as np
+import yaml
+
+# hmosaic package imports
+from hmosaic.utils import switch_ext, atomic_write
+from hmosaic import log, settings
+
+STORE_VERSION = 1
+
+# The C loader is much faster, but only available if libyaml was found when
+# building PyYAML.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class AnalysisStore(object):
+    """
+        Reads and writes the columnar analysis store at ``location``.
+        Unit filepaths are stored relative to ``root`` and returned as
+        absolute paths again.
+
+    """
+
+    def __init__(self, location, root=None):
+        """
+            ``root`` defaults to the directory containing the store.
+
+        """
+        self.location = os.path.abspath(location)
+        if root is None:
+            root = os.path.dirname(self.location)
+        self.root = os.path.abspath(root)
+        self._schema = None
+        self._units = None
+
+    def exists(self):
+        """ Returns True if a complete store is found at the location. """
+
+        return os.path.isfile(os.path.join(self.location, 'schema.yaml'))
+
+    def get_schema(self):
+        """
+            Returns the schema: a dictionary with the number of ``units``
+            and the shape of each of the ``descriptors``.
+
+        """
+        if self._schema is None:
+            f = open(os.path.join(self.location, 'schema.yaml'))
+            try:
+                self._schema = yaml.load(f, Loader=YamlLoader)
+            finally:
+                f.close()
+        return self._schema
+
+    def get_stamp(self):
+        """
+            Returns the modification time of the newest analysis file the
+            store was imported from, None if there was none.
+
+        """
+        return self.get_schema().get('stamp')
+
+    def is_current(self, unit_filepaths):
+        """
+            Returns True if the store holds the current analysis of the 
+            given units: it has a row for each unit with analysis and none
+            of their .yaml files was modified since it was imported.
+
+        """
+        if not self.exists():
+            return False
+        (analysed, stamp) = get_analysis_stamp(unit_filepaths)
+        return analysed == self.list_units() and stamp == self.get_stamp()
+
+    def descriptor_names(self):
+        """ Returns the sorted names of all stored descriptors. """
+
+        return sorted(self.get_schema()['descriptors'])
+
+    def list_units(self):
+        """ Returns the absolute filepaths of the units, in row order. """
+
+        if self._units is None:
+            units = np.load(os.path.join(self.location, 'units.npy'))
+            self._units = [os.path.join(self.root, str(u)) for u in units]
+        return self._units
+
+    def load(self, names=None, mmap=True):
+        """
+            Returns a dictionary of descriptor columns, each an array with
+            one row per unit. ``names`` may be full descriptor names or
+            prefixes of them, e.g. 'lowlevel.pitch' selects all the pitch
+            statistics. All descriptors are returned if it is None.
+            The columns are memory mapped unless ``mmap`` is False.
+
+        """
+        selected = self.select(names)
+        mmap_mode = 'r' if mmap else None
+        return dict((name, np.load(self._column_filepath(name),
+            mmap_mode=mmap_mode)) for name in selected)
+
+    def select(self, names=None):
+        """
+            Returns the stored descriptor names matching ``names``, which
+            may be full names or prefixes.
+
+        """
+        available = self.descriptor_names()
+        if names is None:
+            return available
+        if isinstance(names, basestring):
+            names = [names]
+        selected = []
+        for name in names:
+            matches = [d for d in available if d == name or
+                d.startswith(name + '.')]
+            if len(matches) == 0:
+                raise KeyError("Descriptor '%s' is not in the store: '%s'"
+                    % (name, self.location))
+            selected.extend(m for m in matches if m not in selected)
+        return selected
+
+    def get_analysis(self, unit_filepath, names=None):
+        """
+            Returns the analysis of a single unit as a nested dictionary,
+            like the one read from its .yaml file.
+
+        """
+        index = self.list_units().index(os.path.abspath(unit_filepath))
+        flat = {}
+        for name, column in self.load(names).items():
+            value = column[index]
+            if np.ndim(value) == 0:
+                flat[name] = float(value)
+            else:
+                flat[name] = value.tolist()
+        return unflatten(flat)
+
+    def write(self, unit_filepaths, analyses, stamp=None):
+        """
+            Replaces the store with the given units and their analyses,
+            which are nested dictionaries of descriptors, recording the
+            ``stamp`` of the analysis files they were read from. The store
+            is assembled in a temporary directory beside the location and
+            then moved into place, so readers never see it half written.
+
+        """
+        flat_analyses = [flatten(analysis) for analysis in analyses]
+        shapes = get_shapes(flat_analyses)
+        parent = os.path.dirname(self.location)
+        temp_dir = tempfile.mkdtemp(dir=parent, prefix='.store_')
+        try:
+            descriptors = {}
+            for name, shape in shapes.items():
+                column = np.empty((len(flat_analyses),) + shape)
+                column.fill(np.nan)
+                for row, flat in enumerate(flat_analyses):
+                    if name in flat:
+                        column[row] = flat[name]
+                np.save(os.path.join(temp_dir, name + '.npy'), column)
+                descriptors[name] = list(shape)
+            units = [os.path.relpath(os.path.abspath(u), self.root)
+                for u in unit_filepaths]
+            np.save(os.path.join(temp_dir, 'units.npy'), np.array(units))
+            schema = {'version': STORE_VERSION, 'units': len(units),
+                'descriptors': descriptors, 'stamp': stamp}
+            f = open(os.path.join(temp_dir, 'schema.yaml'), 'w')
+            try:
+                yaml.safe_dump(schema, f, default_flow_style=False)
+            finally:
+                f.close()
+            if os.path.isdir(self.location):
+                shutil.rmtree(self.location)
+            os.rename(temp_dir, self.location)
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        self._schema = None
+        self._units = None
+        log.debug("Stored %d descriptors of %d units in '%s'"
+            % (len(descriptors), len(units), self.location))
+
+    def import_yaml(self, unit_filepaths):
+        """
+            Builds the store from the .yaml analysis of each of the given
+            unit audio files, reading them in parallel. Units without 
+            analysis are assumed to be silent and left out. Returns the 
+            number of units stored.
+
+        """
+        (units, stamp) = get_analysis_stamp(unit_filepaths)
+        analyses = read_analyses([switch_ext(u, '.yaml') for u in units])
+        found = [(u, a) for (u, a) in zip(units, analyses) if a is not None]
+        if len(found) < len(unit_filepaths):
+            log.debug("No analysis for %d units, assume they are silent"
+                % (len(unit_filepaths) - len(found)))
+        self.write([u for (u, a) in found], [a for (u, a) in found], stamp)
+        return len(found)
+
+    def _column_filepath(self, name):
+        return os.path.join(self.location, name + '.npy')
+
+
+class FeatureMatrix(object):
+    """
+        A dense float32 matrix of the numeric descriptors of the units of
+        one chop, saved as ``<location>.npy`` with one row per unit and one 
+        column per descriptor value. It is accompanied by two tables: 
+        ``<location>.names.npy`` names the columns and
+        ``<location>.units.npy`` holds the unit filepaths of the rows, 
+        relative to ``root``. Vector descriptors take a column for each 
+        element, named like 'lowlevel.mfcc.mean[3]'. Units without analysis
+        keep their row, filled with NaN, so that rows can be matched up
+        with the list of units. ``<location>.json``, written last, records
+        the number of units with analysis and the modification time of 
+        the newest .yaml file exported, so that a matrix which is out of 
+        date can be found.
+
+    """
+
+    def __init__(self, location, root=None):
+        """
+            ``root`` defaults to the directory containing the matrix.
+
+        """
+        self.location = os.path.abspath(location)
+        if root is None:
+            root = os.path.dirname(self.location)
+        self.root = os.path.abspath(root)
+
+    def exists(self):
+        """ Returns True if the matrix and all its tables are found. """
+
+        return all(os.path.isfile(f) for f in self._get_filepaths())
+
+    def get_stamp(self):
+        """
+            Returns the modification time of the newest analysis file the
+            matrix was exported from, None if there was none.
+
+        """
+        return self._load_stamp()['stamp']
+
+    def is_current(self, unit_filepaths):
+        """
+            Returns True if the matrix holds the current analysis of the
+            given units: its rows are the units, in order, the same units
+            have analysis and none of their .yaml files was modified since
+            it was exported.
+
+        """
+        if not self.exists():
+            return False
+        if self.list_units() != [os.path.abspath(u) for u in unit_filepaths]:
+            return False
+        (analysed, stamp) = get_analysis_stamp(unit_filepaths)
+        exported = self._load_stamp()
+        return len(analysed) == exported['analysed'] and \
+            stamp == exported['stamp']
+
+    def load(self, mmap=True):
+        """
+            Returns the matrix, memory mapped unless ``mmap`` is False,
+            along with the list of column names and the list of absolute
+            unit filepaths of the rows.
+
+        """
+        (matrix_filepath, names_filepath, units_filepath) = \
+            self._get_filepaths()[:3]
+        matrix = np.load(matrix_filepath, mmap_mode='r' if mmap else None)
+        names = [str(n) for n in np.load(names_filepath)]
+        units = [os.path.join(self.root, str(u)) 
+            for u in np.load(units_filepath)]
+        return (matrix, names, units)
+
+    def list_units(self):
+        """ Returns the absolute unit filepaths of the rows. """
+
+        return [os.path.join(self.root, str(u)) 
+            for u in np.load(self._get_filepaths()[2])]
+
+    def columns(self, names):
+        """
+            Returns the indices of the columns holding the descriptors
+            ``names``, which may be full names or prefixes.
+
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        column_names = [str(n) for n in np.load(self._get_filepaths()[1])]
+        indices = []
+        for name in names:
+            matches = [i for (i, c) in enumerate(column_names) if c == name
+                or c.startswith(name + '[') or c.startswith(name + '.')]
+            if len(matches) == 0:
+                raise KeyError("Descriptor '%s' is not in the matrix: '%s'"
+                    % (name, self.location))
+            indices.extend(i for i in matches if i not in indices)
+        return indices
+
+    def write(self, unit_filepaths, analyses, stamp=None):
+        """
+            Replaces the matrix with the given units and their analyses,
+            which are nested dictionaries of descriptors or None for units
+            without analysis, recording the ``stamp`` of the analysis files
+            they were read from. Each file is written with 
+            ``atomic_write``, the matrix a row at a time, and the stamp
+            last, so the matrix only exists once it is complete.
+
+        """
+        flat_analyses = [flatten(a) if a is not None else {} 
+            for a in analyses]
+        shapes = get_shapes(flat_analyses)
+        names = []
+        spans = {}
+        for name in sorted(shapes):
+            shape = shapes[name]
+            spans[name] = (len(names), len(names) + int(np.prod(shape)))
+            if len(shape) == 0:
+                names.append(name)
+            else:
+                names.extend('%s[%s]' % (name, ','.join(str(i) for i in 
+                    index)) for index in np.ndindex(*shape))
+        (matrix_filepath, names_filepath, units_filepath, stamp_filepath) = \
+            self._get_filepaths()
+        # Without the stamp the matrix is incomplete until it is back.
+        if os.path.isfile(stamp_filepath):
+            os.remove(stamp_filepath)
+
+        def write_matrix(f):
+            np.lib.format.write_array_header_1_0(f, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                'fortran_order': False, 
+                'shape': (len(flat_analyses), len(names))})
+            for flat in flat_analyses:
+                row = np.empty(len(names), np.float32)
+                row.fill(np.nan)
+                for name, value in flat.items():
+                    if name in spans:
+                        (start, stop) = spans[name]
+                        row[start:stop] = np.ravel(value)
+                row.tofile(f)
+        atomic_write(matrix_filepath, write_matrix)
+        units = [os.path.relpath(os.path.abspath(u), self.root)
+            for u in unit_filepaths]
+        for (table, filepath) in ((names, names_filepath), 
+            (units, units_filepath)):
+            atomic_write(filepath, lambda f: np.save(f, 
+                np.array(table, dtype=str)))
+        atomic_write(stamp_filepath, lambda f: json.dump({'version': 1, 
+            'stamp': stamp, 'analysed': len(analyses) - analyses.count(None)},
+                f), 'w')
+        log.debug("Stored %d columns of %d units in '%s'"
+            % (len(names), len(units), matrix_filepath))
+
+    def import_yaml(self, unit_filepaths):
+        """
+            Builds the matrix from the .yaml analysis of each of the given
+            unit audio files, reading them in parallel. Returns the number
+            of units with analysis.
+
+        """
+        stamp = get_analysis_stamp(unit_filepaths)[1]
+        analyses = read_analyses([switch_ext(u, '.yaml') 
+            for u in unit_filepaths])
+        self.write(unit_filepaths, analyses, stamp)
+        return len(filter(None, analyses))
+
+    def _load_stamp(self):
+        f = open(self._get_filepaths()[3])
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _get_filepaths(self):
+        return (self.location + '.npy', self.location + '.names.npy', 
+            self.location + '.units.npy', self.location + '.json')
+
+
+def read_analysis(analysis_filepath, paths=None):
+    """
+        Parses a .yaml analysis file into a nested dictionary. If dotted
+        descriptor ``paths`` are given, e.g. 'lowlevel.pitch.mean', only 
+        a dictionary of their values is returned.
+
+    """
+    f = open(analysis_filepath)
+    try:
+        analysis = yaml.load(f, Loader=YamlLoader)
+    finally:
+        f.close()
+    if paths is None:
+        return analysis
+    return select_paths(analysis, paths)
+
+def read_analyses(analysis_filepaths, paths=None, workers=None):
+    """
+        Parses many .yaml analysis files, in ``workers`` processes, one
+        per cpu by default. Returns a list with the analysis of each file,
+        in order, as returned by ``read_analysis`` for ``paths``. It is 
+        None for files which don't exist, as the analysis of silent units
+        is missing. Any other error reading a file is raised.
+
+    """
+    if workers is None:
+        workers = settings.ANALYSIS_READ_WORKERS or cpu_count()
+    tasks = [(filepath, paths) for filepath in analysis_filepaths]
+    if workers == 1 or len(tasks) < 2 * workers:
+        return map(_read_analysis_task, tasks)
+    pool = Pool(workers)
+    try:
+        return pool.map(_read_analysis_task, tasks,
+            max(1, len(tasks) / (4 * workers)))
+    finally:
+        pool.close()
+        pool.join()
+
+def get_analysis_stamp(unit_filepaths):
+    """
+        Returns the absolute filepaths of the given units which have .yaml
+        analysis, along with the modification time of the newest analysis
+        file, None if there is none.
+
+    """
+    analysed = []
+    stamp = None
+    for unit_filepath in unit_filepaths:
+        analysis_filepath = switch_ext(unit_filepath, '.yaml')
+        if not os.path.isfile(analysis_filepath):
+            continue
+        analysed.append(os.path.abspath(unit_filepath))
+        mtime = os.path.getmtime(analysis_filepath)
+        if stamp is None or mtime > stamp:
+            stamp = mtime
+    return (analysed, stamp)
+
+def get_shapes(flat_analyses):
+    """
+        Returns the shape of each descriptor of the flattened analyses of 
+        many units. Descriptors whose shape varies from unit to unit are
+        left out.
+
+    """
+    shapes = {}
+    for flat in flat_analyses:
+        for name, value in flat.items():
+            shapes.setdefault(name, set()).add(value.shape)
+    dropped = sorted(name for name in shapes if len(shapes[name]) > 1)
+    if dropped:
+        log.debug("Leaving out descriptors of varying shape: %s" % dropped)
+    return dict((name, list(shapes[name])[0]) for name in shapes 
+        if name not in dropped)
+
+def select_paths(analysis, paths):
+    """
+        Returns a dictionary of the values of the dotted descriptor 
+        ``paths`` in the nested ``analysis``. Raises a KeyError if one
+        isn't there.
+
+    """
+    values = {}
+    for path in paths:
+        value = analysis
+        for key in path.split('.'):
+            value = value[key]
+        values[path] = value
+    return values
+
+def _read_analysis_task(task):
+    """ Reads one analysis file in a worker process. """
+
+    (analysis_filepath, paths) = task
+    try:
+        return read_analysis(analysis_filepath, paths)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        log.debug("Analysis not found - must be silent: %s" % e)
+        return None
+
+def flatten(analysis, prefix=''):
+    """
+        Flattens a nested ``analysis`` dictionary into a dictionary of
+        dotted descriptor names and numeric arrays. Values which aren't
+        numeric are left out.
+
+    """
+    flat = {}
+    for key, value in analysis.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+            continue
+        try:
+            value = np.asarray(value)
+        except ValueError:
+            continue
+        if value.dtype.kind in 'biuf':
+            flat[name] = value.astype(float)
+    return flat
+
+def unflatten(flat):
+    """ Inverse of ``flatten``, returns a nested dictionary. """
+
+    analysis = {}
+    for name, value in flat.items():
+        keys = name.split('.')
+        node = analysis
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+    return analysis
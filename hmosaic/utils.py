@@ -6,15 +6,20 @@ the framework.
 """
 
 import os
+import errno
+import tempfile
 from glob import glob
 from datetime import datetime
 import subprocess
+import hashlib
+import struct
 
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import yaml
 from gaia2 import Point
-from scikits.audiolab import wavwrite
+from scikits.audiolab import wavwrite, wavread
 
 from hmosaic import log
 from storm.sqlobject import Store
@@ -40,6 +45,220 @@ def to_mono(audio_data):
         return mono_array.astype('single')
         
         
+# Numpy types for the wav sample encodings which can be memory mapped, keyed
+# on (format tag, bits per sample). 
+WAV_DTYPES = {
+    (1, 16): '<i2',
+    (1, 32): '<i4',
+    (3, 32): '<f4',
+    (3, 64): '<f8'
+}
+
+def read_wav_memmap(filepath):
+    """
+        Reads the wav file at ``filepath`` without decoding it: the samples
+        are a read only memory map of the file, so only the parts which are
+        used are ever read from disk. Returns the samples (one column per
+        channel if there is more than one), the sample rate and the 
+        encoding, e.g. 'pcm16'. 
+        Encodings which can't be mapped (e.g. 24 bit) are decoded with 
+        ``wavread`` instead.
+
+    """
+    f = open(filepath, 'rb')
+    try:
+        (riff, riff_size, wave) = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise IOError("Not a wav file: '%s'" % filepath)
+        tag = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise IOError("No audio data found in '%s'" % filepath)
+            (chunk_id, chunk_size) = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                (tag, channels, sample_rate, byte_rate, block_align, 
+                    bits) = struct.unpack('<HHIIHH', fmt[:16])
+                # WAVE_FORMAT_EXTENSIBLE keeps the real tag in its subformat
+                if tag == 0xFFFE and len(fmt) >= 26:
+                    tag = struct.unpack('<H', fmt[24:26])[0]
+                f.seek(chunk_size % 2, 1)
+            elif chunk_id == b'data' and tag is not None:
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+    finally:
+        f.close()
+    if (tag, bits) not in WAV_DTYPES:
+        log.debug("Can't memory map '%s', decoding it" % filepath)
+        return wavread(filepath)
+    # The size in the header can't be trusted for files which were being 
+    # streamed when written.
+    chunk_size = min(chunk_size, os.path.getsize(filepath) - offset)
+    frames = chunk_size / block_align
+    dtype = np.dtype(WAV_DTYPES[(tag, bits)])
+    if frames == 0:
+        audio_data = np.zeros(0, dtype)
+    else:
+        audio_data = np.memmap(filepath, dtype=dtype, mode='r', 
+            offset=offset, shape=(frames * channels,))
+    if channels > 1:
+        audio_data = audio_data.reshape((-1, channels))
+    encoding = {'i': 'pcm', 'f': 'float'}[dtype.kind] + str(bits)
+    return audio_data, sample_rate, encoding
+
+# Name of the index file of a directory of virtual units.
+UNIT_INDEX = 'units.index.npz'
+
+# Unit indexes which have been read, by filepath, with their modification 
+# time.
+_unit_indexes = {}
+
+def write_unit_index(unit_dir, source_filepath, boundaries):
+    """
+        Writes the index of a directory of virtual units. Instead of each 
+        unit being its own wav file, the index records the source audio and
+        the (start, length) in samples of each unit in ``boundaries``. The
+        units are still named '%07d.wav' by their position in the index, 
+        but these files don't exist, their audio is read from the source
+        by ``read_unit``. The source is stored relative to ``unit_dir``.
+
+    """
+    boundaries = np.array(list(boundaries), dtype='int64').reshape((-1, 2))
+    source = os.path.relpath(os.path.abspath(source_filepath), 
+        os.path.abspath(unit_dir))
+    atomic_write(os.path.join(unit_dir, UNIT_INDEX), lambda f: np.savez(f, 
+        source=np.array(source), starts=boundaries[:, 0], 
+            lengths=boundaries[:, 1]))
+    return len(boundaries)
+
+def get_unit_index(unit_dir):
+    """
+        Returns the index of the virtual units in ``unit_dir`` as a 
+        dictionary with the ``source`` filepath and arrays of the ``starts``
+        and ``lengths`` of the units, or None if the units are wav files.
+
+    """
+    index_filepath = os.path.join(os.path.abspath(unit_dir), UNIT_INDEX)
+    try:
+        mtime = os.path.getmtime(index_filepath)
+    except OSError:
+        return None
+    cached = _unit_indexes.get(index_filepath)
+    if cached is None or cached[0] != mtime:
+        entry = np.load(index_filepath)
+        try:
+            index = {
+                'source': os.path.normpath(os.path.join(
+                    os.path.dirname(index_filepath), str(entry['source']))),
+                'starts': entry['starts'],
+                'lengths': entry['lengths']
+            }
+        finally:
+            entry.close()
+        cached = (mtime, index)
+        _unit_indexes[index_filepath] = cached
+    return cached[1]
+
+def list_virtual_units(unit_dir):
+    """
+        Returns the filepaths of the virtual units in ``unit_dir``, an 
+        empty list if it has no unit index.
+
+    """
+    index = get_unit_index(unit_dir)
+    if index is None:
+        return []
+    return [os.path.join(unit_dir, '%07d.wav' % i) 
+        for i in range(len(index['starts']))]
+
+def is_virtual_unit(filepath):
+    """
+        Returns True if ``filepath`` is a unit read from a source file 
+        through the index of its directory, rather than a wav file.
+
+    """
+    return not os.path.isfile(filepath) and \
+        get_unit_index(os.path.dirname(filepath)) is not None
+
+def read_unit(filepath):
+    """
+        Reads a unit, which may be a wav file or a virtual unit. Returns 
+        the samples as floating point numbers (like ``wavread``), the sample 
+        rate and the encoding, e.g. 'pcm16'. Only the samples of a virtual 
+        unit are read from its source.
+
+    """
+    if not is_virtual_unit(filepath):
+        return wavread(filepath)
+    (source, start, length) = locate_virtual_unit(filepath)
+    (audio_data, sample_rate, encoding) = read_wav_memmap(source)
+    audio_data = to_float(audio_data[start:start + length])
+    return audio_data.astype('double'), sample_rate, encoding
+
+def locate_virtual_unit(filepath):
+    """
+        Returns the source filepath of the virtual unit at ``filepath`` 
+        and its start and length in samples, from the index of its 
+        directory, without reading any audio.
+
+    """
+    index = get_unit_index(os.path.dirname(filepath))
+    try:
+        row = int(os.path.splitext(os.path.basename(filepath))[0])
+        start = int(index['starts'][row])
+        length = int(index['lengths'][row])
+    except (TypeError, ValueError, IndexError):
+        raise IOError("No such unit: '%s'" % filepath)
+    return index['source'], start, length
+
+def export_unit(unit_filepath, filepath=None):
+    """
+        Writes the audio of a unit, which may be virtual, to the wav file
+        at ``filepath``, in the encoding of the unit. A temporary file is
+        created if no ``filepath`` is given, which the caller must remove.
+        Returns the filepath written.
+
+    """
+    (audio_data, sample_rate, encoding) = read_unit(unit_filepath)
+    if filepath is None:
+        (fd, filepath) = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+    wavwrite(audio_data, filepath, sample_rate, enc=encoding)
+    return filepath
+
+def to_float(audio_data):
+    """
+        Returns a 32bit floating point copy of ``audio_data``, scaling 
+        integer samples to the range -1 to 1 like ``wavread`` does.
+
+    """
+    if audio_data.dtype.kind == 'i':
+        float_data = audio_data.astype('single')
+        float_data /= 2 ** (8 * audio_data.dtype.itemsize - 1)
+        return float_data
+    return audio_data.astype('single')
+
+def get_frame_matrix(audio_data, frame_size, hop_size):
+    """
+        Returns every complete frame of ``audio_data`` as the rows of a 
+        matrix, with frames starting every ``hop_size`` samples. Leftover 
+        samples which can't fill a frame are ignored. The matrix is a 
+        strided view of the audio, so no samples are copied.
+
+    """
+    audio_data = np.ascontiguousarray(audio_data)
+    if len(audio_data) < frame_size:
+        no_frames = 0
+    else:
+        no_frames = (len(audio_data) - frame_size)/hop_size + 1
+    stride = audio_data.strides[0]
+    return as_strided(audio_data, shape=(no_frames, frame_size),
+        strides=(hop_size*stride, stride))
+        
+        
 # Returns a chop value in ms from the bpm value.        
 calc_chop_from_bpm = lambda bpm: int((60 * 1000) / float(bpm)) 
 
@@ -50,8 +269,8 @@ secs_to_samps = lambda time, sr: int(round(time*sr))
 chop_to_ms = lambda sr, chop: int(sr*(float(chop)/float(1000)))
 
 # Returns onset times in seconds as an array of 32bit floating point numbers
-get_fixed_onsets = lambda chop, length: np.array(map(
-    lambda x: float((x * chop)/1000.0), range(length/chop)), 'single')
+get_fixed_onsets = lambda chop, length: (np.arange(int(length) / chop) * 
+    chop / 1000.0).astype('single')
        
 
 
@@ -86,6 +305,58 @@ def get_files_recursive(directory, ext = '.wav'):
                 filepaths.append(filepath)
     filepaths.sort()
     return filepaths
+
+def file_hash(filepath, block_size=1048576):
+    """
+        Returns the sha1 hex digest of the contents of the file at 
+        ``filepath``. The file is read in blocks of ``block_size`` bytes so
+        large audio files are never held in memory.
+
+    """
+    sha = hashlib.sha1()
+    f = open(filepath, 'rb')
+    try:
+        block = f.read(block_size)
+        while block:
+            sha.update(block)
+            block = f.read(block_size)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+def make_dirs(path):
+    """
+        Creates the directory at ``path`` and its parents, tolerating the 
+        directory being created by another thread or process first.
+
+    """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def atomic_write(filepath, write_entry, mode='wb'):
+    """
+        Writes ``filepath`` by passing a temporary file in the same 
+        directory, opened with ``mode``, to ``write_entry`` and renaming it
+        over ``filepath``, so other processes never read a partial file.
+        The temporary file is removed if writing fails.
+
+    """
+    (fd, tmp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filepath)))
+    f = os.fdopen(fd, mode)
+    try:
+        try:
+            write_entry(f)
+        finally:
+            f.close()
+        os.rename(tmp_path, filepath)
+    except:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
     
     
 ###############################################################################
@@ -110,7 +381,8 @@ def load_yaml(self, analysis_filepath):
             given an ``analysis_filepath``
             
         """
-        return yaml.load(open(switch_ext(analysis_filepath, '.yaml')))
+        from hmosaic.store import read_analysis
+        return read_analysis(switch_ext(analysis_filepath, '.yaml'))
 
 def prepare_thresholds(func, *args):
         """